@@ -0,0 +1,22 @@
+import data
+import time
+
+from typing import List
+from fastapi import APIRouter
+from .models import ApiStatus
+
+from constants import *
+
+router = APIRouter(prefix="/status", tags=["status"])
+
+
+@router.get("/rally", response_model=List[ApiStatus])
+async def read_rally_status():
+    statuses = []
+    for status in data.get_api_statuses("rally") or []:
+        status = dict(status)
+        # stored when the breaker opened, it lets requests through again once the cooldown is over
+        if status[STATE_KEY] == "open" and status[OPEN_UNTIL_KEY] <= time.time():
+            status[STATE_KEY] = "half_open"
+        statuses.append(status)
+    return statuses
@@ -40,18 +40,31 @@ class AlertsSettings(BaseModel):
     settings: Optional[Dict] = None
     error: Optional[str] = None
 
-      
+
 class CoinPrice(BaseModel):
     coinKind: str
     priceInUSD: str
     usd_24h_change: Optional[str] = None
 
 
+class CoinMarketData(BaseModel):
+    symbol: str
+    current_price: Optional[float] = None
+    price_change_percentage_24h: Optional[float] = None
+    price_change_percentage_30d: Optional[float] = None
+
+
 class CoinPrices(BaseModel):
     id: Optional[int] = None
     timeCreated: datetime
     coinKind: str
     priceInUSD: str
+    open: Optional[float] = None
+    high: Optional[float] = None
+    low: Optional[float] = None
+    close: Optional[float] = None
+    avg: Optional[float] = None
+    samples: Optional[int] = None
 
 
 class BotNameMapping(BaseModel):
@@ -80,3 +93,37 @@ class BotActivityMapping(BaseModel):
     success: Optional[str] = None
     activity_type: Optional[str] = None
     activity_text: Optional[str] = None
+
+
+class SyncStatus(BaseModel):
+    guildId: str
+    lastFullSync: Optional[float] = None
+    syncInterval: Optional[float] = None
+    webhookEvents: Optional[int] = None
+
+
+class SyncPlan(BaseModel):
+    guildId: str
+    pending: bool = False
+    timeCreated: Optional[float] = None
+    members: Optional[int] = None
+    linkedMembers: Optional[int] = None
+    evaluated: Optional[int] = None
+    failedBalances: Optional[int] = None
+    staleBalances: Optional[int] = None
+    balanceRequests: Optional[int] = None
+    mappings: Optional[int] = None
+    timings: Optional[Dict[str, float]] = None
+    roleDiffs: Optional[List[Dict]] = None
+    channelDiffs: Optional[List[Dict]] = None
+
+
+class ApiStatus(BaseModel):
+    service: str
+    workerId: str
+    state: str
+    failures: int
+    trips: int
+    openUntil: Optional[float] = None
+    cooldown: float
+    timeUpdated: float
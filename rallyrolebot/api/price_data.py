@@ -1,20 +1,67 @@
+import time
+
 import data
 import rally_api
+import coingecko_api
 
 from typing import List, Optional
-from fastapi import APIRouter, Query
-from .models import CoinPrice, CoinPrices
-
+from fastapi import APIRouter, HTTPException, Query
+from .models import CoinPrice, CoinPrices, CoinMarketData
+from constants import *
 
 router = APIRouter(prefix="/coins", tags=["coins"])
 
+# coin -> (time fetched, price), dashboards request the same coins over and over
+current_prices = {}
+
+
+async def get_current_price(coin):
+    """
+    @return: the current price of a coin, at most CURRENT_PRICE_TTL seconds old
+    @raise RallyAPIError: if the price can't be fetched
+    """
+    entry = current_prices.get(coin)
+    if entry is not None and time.monotonic() - entry[0] < CURRENT_PRICE_TTL:
+        return entry[1]
+    price = await rally_api.client.get_current_price(coin)
+    current_prices[coin] = (time.monotonic(), price)
+    return price
+
+
+@router.get("/market_data", response_model=List[CoinMarketData])
+async def read_market_data(
+    symbols: str = Query(
+        ...,
+        title="Query string",
+        description="Comma separated CoinGecko coin symbols, e.g. btc,eth",
+    ),
+):
+    symbols = [symbol for symbol in dict.fromkeys(symbols.split(",")) if symbol]
+    try:
+        price_data = await coingecko_api.get_price_data_many_async(symbols)
+    except coingecko_api.CoinGeckoAPIError as e:
+        raise HTTPException(status_code=502, detail=str(e))
+    # coins without market data are listed without prices, unknown symbols are left out
+    return [
+        {"symbol": symbol, **(coin_data or {})}
+        for symbol, coin_data in price_data.items()
+        if coin_data is not False
+    ]
+
 
 @router.get("/{coin}/price", response_model=CoinPrice)
 async def read_price(coin: str, include_24hr_change: Optional[bool] = False):
-    price = rally_api.get_current_price(coin)
+    try:
+        price = await get_current_price(coin)
+    except rally_api.RallyAPIError as e:
+        if e.status == 404:
+            raise HTTPException(status_code=404, detail="Coin not found")
+        raise HTTPException(status_code=502, detail=str(e))
     if not include_24hr_change:
         return {"coinKind": coin, "priceInUSD": price["priceInUSD"]}
     last_24hr = data.get_last_24h_price(coin)
+    if last_24hr is None:
+        return {"coinKind": coin, "priceInUSD": str(price["priceInUSD"])}
     percentage_24h_change = (
         (float(price["priceInUSD"]) - float(last_24hr["priceInUSD"]))
         / float(last_24hr["priceInUSD"])
@@ -34,5 +81,22 @@ async def read_prices(
         title="Query string",
         description="Maximum number of data points to return",
     ),
+    resolution: Optional[str] = Query(
+        None,
+        regex="^(hour|day)$",
+        description="Return hourly or daily open, high, low, close and average prices "
+        "instead of every sampled price, for ranges longer than the sampled prices are kept",
+    ),
 ):
-    return list(reversed([prices for prices in data.get_coin_prices(coin, limit)]))
+    if resolution is None:
+        return list(reversed([prices for prices in data.get_coin_prices(coin, limit)]))
+
+    # priceInUSD is the close of the hour or day, so clients of sampled prices can read rollups
+    return list(
+        reversed(
+            [
+                {**rollup, PRICE_KEY: str(rollup[CLOSE_KEY])}
+                for rollup in data.get_coin_price_rollups(coin, resolution, limit)
+            ]
+        )
+    )
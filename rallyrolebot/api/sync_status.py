@@ -0,0 +1,52 @@
+import data
+
+import config
+
+config.parse_args()
+
+from fastapi import APIRouter, Depends, HTTPException
+from .dependencies import owner_or_admin
+from .models import SyncStatus, SyncPlan
+
+from constants import *
+
+router = APIRouter(
+    prefix="/sync",
+    tags=["sync"],
+    dependencies=[Depends(owner_or_admin)],
+    responses={404: {"description": "Not found"}},
+)
+
+
+@router.get("/{guildId}", response_model=SyncStatus)
+async def read_sync_status(guildId: str):
+    status = data.get_guild_sync_status(int(guildId))
+    if not status:
+        return {"guildId": guildId}
+    return {
+        "guildId": guildId,
+        "lastFullSync": status[LAST_FULL_SYNC_KEY],
+        "syncInterval": status[SYNC_INTERVAL_KEY],
+        "webhookEvents": status[WEBHOOK_EVENTS_KEY],
+    }
+
+
+@router.get("/{guildId}/plan", response_model=SyncPlan)
+async def read_sync_plan(guildId: str):
+    report = data.get_sync_plan(int(guildId))
+    if not report:
+        raise HTTPException(status_code=404, detail="No plan has been made yet")
+    return report
+
+
+@router.post("/{guildId}/plan", response_model=SyncPlan)
+async def create_sync_plan(guildId: str):
+    # the dry run needs the discord client, so the bot runs it and stores the report
+    task = {
+        "kwargs": {
+            "guild_id": int(guildId),
+        },
+        "function": "plan_guild_sync",
+    }
+    data.add_task(task)
+    return {"guildId": guildId, "pending": True}
@@ -5,7 +5,9 @@ import logging
 import time
 from fastapi import FastAPI
 from fastapi.middleware.cors import CORSMiddleware
+from starlette.concurrency import run_in_threadpool
 from utils.tasks import repeat_every
+from utils.price_poller import PricePoller
 from api import (
     channel_mappings,
     role_mappings,
@@ -18,12 +20,13 @@ from api import (
     bot_instance_mappings,
     bot_name_mappings,
     bot_activity_mappings,
-    webhooks_mapping
+    webhooks_mapping,
+    sync_status,
+    api_status,
 )
 
 import config
 import data
-import rally_api
 
 from constants import *
 
@@ -56,6 +59,8 @@ app.include_router(bot_avatar_mappings.router)
 app.include_router(bot_activity_mappings.router)
 app.include_router(alerts_settings_mappings.router)
 app.include_router(webhooks_mapping.router)
+app.include_router(sync_status.router)
+app.include_router(api_status.router)
 
 
 @app.get("/")
@@ -66,23 +71,27 @@ async def root():
     }
 
 
+price_poller = PricePoller(
+    int(config.CONFIG.price_interval), int(config.CONFIG.price_concurrency)
+)
+
+
+@app.on_event("startup")
+@repeat_every(seconds=PRICE_POLL_TICK, logger=logger)
+async def get_prices():
+    prices = await price_poller.poll()
+    if prices:
+        print(f"Price cache updated with {len(prices)} prices")
+
+
 @app.on_event("startup")
-@repeat_every(seconds=60 * 60, logger=logger)
-def get_prices():
-    coins = rally_api.get_creator_coins()
-    for coin in coins:
-        try:
-            symbol = coin["coinSymbol"]
-            price = rally_api.get_current_price(symbol)
-            data.add_coin_price(str(price["priceInUSD"]), symbol)
-        except:
-            print(f"Failed to get price for {coin['coinSymbol']}")
-    count = data.price_count()
-    max = int(config.CONFIG.cache_max)
-    print(f"Price cache updated, Count: {count}, Max: {max}")
-    if count > max:
-        data.clean_price_cache(count - max)
-        print(f"{count - max} cache entries removed")
+@repeat_every(seconds=PRICE_RETENTION_TICK, logger=logger)
+async def delete_old_prices():
+    await run_in_threadpool(
+        data.delete_old_coin_prices,
+        int(config.CONFIG.price_retention_days),
+        int(config.CONFIG.hourly_price_retention_days),
+    )
 
 
 if __name__ == "__main__":
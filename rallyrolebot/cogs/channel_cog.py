@@ -75,20 +75,37 @@ class ChannelCommands(commands.Cog):
         self, ctx, coin_name, coin_amount: int, channel: discord.TextChannel
     ):
 
+        data.load_rally_connections()
+        linked_members = []
         for member in ctx.guild.members:
-            rally_id = data.get_rally_id(member.id)
+            rally_id = data.rally_connections.get(member.id)
             if rally_id:
-                balances = rally_api.get_balances(rally_id)
-                await update_cog.grant_deny_channel_to_member(
-                    {
-                        data.GUILD_ID_KEY: ctx.guild.id,
-                        data.COIN_KIND_KEY: coin_name,
-                        data.REQUIRED_BALANCE_KEY: coin_amount,
-                        data.CHANNEL_NAME_KEY: channel.name,
-                    },
-                    member,
-                    balances,
-                )
+                linked_members.append((member, rally_id))
+
+        all_balances = await update_cog.balance_table.get_many(
+            [rally_id for _, rally_id in linked_members]
+        )
+        channel_mapping = {
+            data.GUILD_ID_KEY: ctx.guild.id,
+            data.COIN_KIND_KEY: coin_name,
+            data.REQUIRED_BALANCE_KEY: coin_amount,
+            data.CHANNEL_NAME_KEY: channel.name,
+        }
+        await update_cog.reconcile_channel_overwrites(
+            update_cog.ThresholdIndex([], [channel_mapping]),
+            ctx.guild,
+            [
+                (member, rally_api.balances_by_coin(all_balances[rally_id]))
+                for member, rally_id in linked_members
+                if all_balances[rally_id] is not None
+            ],
+            update_cog.mutation_scheduler,
+            grant_only={
+                member
+                for member, rally_id in linked_members
+                if isinstance(all_balances[rally_id], update_cog.LastKnownBalances)
+            },
+        )
         await update_cog.force_update(self.bot, ctx)
 
     @commands.command(
@@ -115,8 +115,11 @@ class DefaultsCommands(commands.Cog):
         else:
             coin_stats = update_cog.get_week_stats(default_coin)
 
-        rewards = rally_api.get_coin_rewards(default_coin)
-        coin_image_url = rally_api.get_coin_image_url(default_coin)
+        try:
+            rewards = await rally_api.client.get_coin_rewards(default_coin)
+        except rally_api.RallyAPIError:
+            raise errors.RequestError("network error, try again later")
+        coin_image_url = await rally_api.catalogue.image_url(default_coin)
 
         # format message, done through dict to make keeping this and daily_stats message similar easier
         extra_str = 'Today' if timeframe == 'day' else 'This Week'
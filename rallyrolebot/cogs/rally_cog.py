@@ -1,3 +1,4 @@
+import asyncio
 import json
 import sys
 import traceback
@@ -42,7 +43,14 @@ class RallyCommands(commands.Cog):
     @commands.command(name="set_rally_id", help="Set your rally id")
     @commands.dm_only()
     async def set_rally_id(self, ctx, rally_id):
-        data.add_discord_rally_mapping(ctx.author.id, rally_id)
+        # the username lets webhook events, which only carry usernames, find this account
+        try:
+            user = await rally_api.client.get_user(rally_id)
+        except rally_api.RallyAPIError as e:
+            print(e)
+            user = None
+        rally_username = user.get(USERNAME_KEY) if user else None
+        data.add_discord_rally_mapping(ctx.author.id, rally_id, rally_username)
 
     @commands.command(name="price", help="Get the price data of a coin")
     async def price(self, ctx, coin: Union[CreatorCoin, CommonCoin]):
@@ -85,6 +93,49 @@ class RallyCommands(commands.Cog):
                 color=get_gradient_color(percentage_30d),
             )
 
+    @commands.command(
+        name="prices", help="<coin names> Get the price data of several coins at once"
+    )
+    async def prices(self, ctx, *symbols):
+        if not symbols:
+            raise errors.BadArgument("<coin names> must name at least one coin")
+        symbols = list(dict.fromkeys(symbols))[:PRICES_MAX_COINS]
+
+        # creator coins come from Rally, every other coin from one CoinGecko request
+        creator_coins = [
+            symbol for symbol in symbols if await rally_api.catalogue.exists(symbol)
+        ]
+        try:
+            price_data = await coingecko_api.get_price_data_many_async(
+                [symbol for symbol in symbols if symbol not in creator_coins]
+            )
+            creator_price_data = await asyncio.gather(
+                *[rally_api.get_price_data_async(symbol) for symbol in creator_coins]
+            )
+        except (coingecko_api.CoinGeckoAPIError, rally_api.RallyAPIError):
+            raise errors.RequestError("network error, try again later")
+        price_data.update(zip(creator_coins, creator_price_data))
+
+        fields = []
+        for symbol in symbols:
+            coin_data = price_data[symbol]
+            if coin_data is None:
+                fields.append([symbol, "No market data", False])
+                continue
+            if not coin_data:
+                fields.append([symbol, "Invalid coin symbol", False])
+                continue
+            fields.append(
+                [
+                    symbol,
+                    f"Current Price: {coin_data['current_price']}\n"
+                    f"24H Price Change: {coin_data['price_change_percentage_24h']}%\n"
+                    f"30D Price Change: {coin_data['price_change_percentage_30d']}%",
+                    False,
+                ]
+            )
+        await pretty_print(ctx, fields, title="Current Prices", color=WHITE_COLOR)
+
     @commands.command(name="unset_rally_id", help="Unset your rally id")
     @commands.dm_only()
     async def unset_rally_id(self, ctx, rally_id):
@@ -123,7 +174,10 @@ class RallyCommands(commands.Cog):
     @validation.is_wallet_verified()
     async def balance(self, ctx):
         rally_id = data.get_rally_id(ctx.message.author.id)
-        balances = rally_api.get_balances(rally_id)
+        try:
+            balances = await rally_api.client.get_balances(rally_id)
+        except rally_api.RallyAPIError:
+            raise errors.RequestError("network error, try again later")
 
         balanceStr = ""
 
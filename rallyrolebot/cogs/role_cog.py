@@ -55,20 +55,34 @@ class RoleCommands(commands.Cog):
     async def one_time_role_mapping(
         self, ctx, coin_name, coin_amount: int, role: discord.Role
     ):
+        data.load_rally_connections()
+        linked_members = []
         for member in ctx.guild.members:
-            rally_id = data.get_rally_id(member.id)
+            rally_id = data.rally_connections.get(member.id)
             if rally_id:
-                balances = rally_api.get_balances(rally_id)
-                await update_cog.grant_deny_role_to_member(
-                    {
-                        data.GUILD_ID_KEY: ctx.guild.id,
-                        data.COIN_KIND_KEY: coin_name,
-                        data.REQUIRED_BALANCE_KEY: coin_amount,
-                        data.ROLE_NAME_KEY: role.name,
-                    },
-                    member,
-                    balances,
-                )
+                linked_members.append((member, rally_id))
+
+        all_balances = await update_cog.balance_table.get_many(
+            [rally_id for _, rally_id in linked_members]
+        )
+        role_mapping = {
+            data.GUILD_ID_KEY: ctx.guild.id,
+            data.COIN_KIND_KEY: coin_name,
+            data.REQUIRED_BALANCE_KEY: coin_amount,
+            data.ROLE_NAME_KEY: role.name,
+        }
+        threshold_index = update_cog.ThresholdIndex([role_mapping], [])
+        for member, rally_id in linked_members:
+            balances = all_balances[rally_id]
+            if balances is None:
+                continue
+            await update_cog.reconcile_member_roles(
+                threshold_index,
+                member,
+                rally_api.balances_by_coin(balances),
+                update_cog.mutation_scheduler,
+                revoke=not isinstance(balances, update_cog.LastKnownBalances),
+            )
         await update_cog.force_update(self.bot, ctx)
 
     @commands.command(
@@ -5,8 +5,13 @@ import time
 import datetime
 import discord
 import discord.utils
+import bisect
+import hashlib
+import itertools
+import json
 import re
 
+from collections import Counter, OrderedDict, deque
 from typing import Optional
 from discord.ext import commands
 from discord.ext import tasks as discord_tasks
@@ -20,9 +25,16 @@ import asyncio
 import errors
 import data
 import rally_api
+import coingecko_api
 import validation
 import requests
 from utils import pretty_print
+from utils.mutations import (
+    MutationPlan,
+    MutationScheduler,
+    MemberRolesMutation,
+    ChannelOverwritesMutation,
+)
 
 main_bot = None
 running_bots = {}
@@ -79,7 +91,7 @@ async def format_alert_message(event: str, payload: dict, instance: dict) -> dic
     if 'showUsername' not in payload['data'] or not payload['data']['showUsername']:
         payload['data']['username'] = 'someone'
 
-    coin_image_url = rally_api.get_coin_image_url(payload['coinKind'])
+    coin_image_url = await rally_api.catalogue.image_url(payload["coinKind"])
 
     # move values from data to the root of payload
     payload.update(payload['data'])
@@ -173,6 +185,27 @@ async def process_payload(payload: dict, failed: bool = False) -> None:
     event = payload['event'].lower()
     data.add_event(event, coin_kind)
 
+    # resync the members involved now instead of on the next update cycle,
+    # before the alert formatting below replaces hidden usernames
+    if not failed:
+        usernames = [
+            payload["data"][key]
+            for key in ["username", "fromUsername", "toUsername"]
+            if payload["data"].get(key)
+        ]
+        coins = {coin_kind} | {
+            payload["data"][key]
+            for key in ["fromCoinKind", "toCoinKind"]
+            if payload["data"].get(key)
+        }
+        if usernames:
+            data.add_task(
+                {
+                    "kwargs": {"usernames": usernames, "coins": list(coins)},
+                    "function": "resync_rally_users",
+                }
+            )
+
     # find guilds that have coin_kind as default coin and loop through them
     guilds = data.get_guilds_by_coin(coin_kind)
     for guild in guilds:
@@ -222,89 +255,941 @@ async def process_payload(payload: dict, failed: bool = False) -> None:
                     return await process_payload(payload, True)
 
 
-async def grant_deny_channel_to_member(channel_mapping, member, balances):
+class ThresholdIndex:
     """
-    Determine if the rally_id and balance for a channel is still valid for a particular member
-    Update status in database.
+    Role and channel mappings of a guild, sorted by requiredBalance per coin.
 
-    Parameters
-    __________
+    A single bisect per coin yields every role and channel a member's
+    balance satisfies, instead of checking each mapping on its own.
+    """
 
-      channel_mapping  (list) - list of information for the channel mapped to the member
-      member (discord.Member) - The discord member to check
-      balances (list)  - The amount of coin allocated to this member per coin
+    def __init__(self, role_mappings, channel_mappings):
+        role_mappings = list(role_mappings)
+        channel_mappings = list(channel_mappings)
+        entries = {}
+        for mapping in role_mappings:
+            entries.setdefault(mapping[data.COIN_KIND_KEY], []).append(
+                (
+                    float(mapping[data.REQUIRED_BALANCE_KEY]),
+                    "role",
+                    mapping[data.ROLE_NAME_KEY],
+                )
+            )
+        for mapping in channel_mappings:
+            entries.setdefault(mapping[data.COIN_KIND_KEY], []).append(
+                (
+                    float(mapping[data.REQUIRED_BALANCE_KEY]),
+                    "channel",
+                    mapping[data.CHANNEL_NAME_KEY],
+                )
+            )
 
+        self.thresholds = {}
+        self.targets = {}
+        for coin, coin_entries in entries.items():
+            coin_entries.sort(key=lambda entry: entry[0])
+            self.thresholds[coin] = [entry[0] for entry in coin_entries]
+            self.targets[coin] = [(kind, name) for _, kind, name in coin_entries]
+
+        self.role_names = {mapping[data.ROLE_NAME_KEY] for mapping in role_mappings}
+        self.channel_names = {
+            mapping[data.CHANNEL_NAME_KEY] for mapping in channel_mappings
+        }
+        self.signature = sorted(
+            [kind, coin, str(threshold), name]
+            for coin, coin_entries in entries.items()
+            for threshold, kind, name in coin_entries
+        )
+        self.roles = None
+
+    def __len__(self):
+        return len(self.signature)
+
+    @property
+    def coins(self):
+        return sorted(self.thresholds)
+
+    def satisfied(self, coin_balances):
+        """
+        @param coin_balances: dict of coin -> balance
+        @return: tuple of (set of role names, set of channel names) the balances satisfy
+        """
+        role_names = set()
+        channel_names = set()
+        for coin, thresholds in self.thresholds.items():
+            count = bisect.bisect_right(thresholds, coin_balances.get(coin, 0.0))
+            for kind, name in self.targets[coin][:count]:
+                if kind == "role":
+                    role_names.add(name)
+                else:
+                    channel_names.add(name)
+        return role_names, channel_names
+
+    def resolve_roles(self, guild):
+        """
+        @param guild: discord.Guild the mappings belong to
+        @return: dict of role name -> discord.Role for every mapped role that exists
+        """
+        if self.roles is None:
+            self.roles = {}
+            for role in guild.roles:
+                if role.name in self.role_names:
+                    self.roles.setdefault(role.name, role)
+            for role_name in self.role_names - set(self.roles):
+                print("Can't find role")
+                print(role_name)
+        return self.roles
+
+
+def balance_fingerprint(threshold_index, coin_balances):
     """
+    Fingerprint of everything the evaluation of a member in a guild depends on.
 
-    print("Checking channel")
-    rally_id = data.get_rally_id(member.id)
-    if rally_id is None or balances is None:
-        return
-    matched_channels = [
-        channel
-        for channel in member.guild.channels
-        if channel.name == channel_mapping[data.CHANNEL_NAME_KEY]
+    Balances are reduced to the coins the guild's mappings reference, so
+    holdings of unrelated coins never cause a re-evaluation. The mappings
+    themselves are part of the fingerprint, so editing them re-evaluates
+    every member of the guild.
+
+    @param threshold_index: ThresholdIndex of the guild
+    @param coin_balances: dict of coin -> balance of the member's rally id
+    @return: hex digest
+    """
+    reduced_balances = [
+        [coin, coin_balances.get(coin, 0.0)] for coin in threshold_index.coins
     ]
-    if len(matched_channels) == 0:
-        return
+    return hashlib.sha1(
+        json.dumps([threshold_index.signature, reduced_balances]).encode()
+    ).hexdigest()
 
-    channel_to_assign = matched_channels[0]
-    if channel_to_assign is not None:
-        if (
-                rally_api.find_balance_of_coin(
-                    channel_mapping[data.COIN_KIND_KEY], balances
-                )
-                >= channel_mapping[data.REQUIRED_BALANCE_KEY]
-        ):
-            perms = channel_to_assign.overwrites_for(member)
-            perms.send_messages = True
-            perms.read_messages = True
-            perms.read_message_history = True
-            await channel_to_assign.set_permissions(member, overwrite=perms)
-            print("Assigned channel to member")
-        else:
-            perms = channel_to_assign.overwrites_for(member)
-            perms.send_messages = False
-            perms.read_messages = False
-            perms.read_message_history = False
-            await channel_to_assign.set_permissions(member, overwrite=perms)
-            print("Removed channel to member")
+
+async def reconcile_member_roles(
+    threshold_index, member, coin_balances, scheduler=None, revoke=True
+):
+    """
+    Bring the mapped roles of a member in line with all role mappings of its guild.
+
+    The target role set is computed from every mapping at once and diffed
+    against member.roles, so at most one member.edit call is sent and only
+    when something actually changed.
+
+    @param threshold_index: ThresholdIndex of the member's guild
+    @param member: discord.Member to reconcile
+    @param coin_balances: dict of coin -> balance of the member's rally id
+    @param scheduler: MutationScheduler to queue the edit on, applied right away if None
+    @param revoke: False to only add roles, for balances that may be outdated
+    @return: tuple of (edits sent, role mutations skipped compared to one call per mapping)
+    """
+    if coin_balances is None or not threshold_index.role_names:
+        return 0, 0
+
+    roles = threshold_index.resolve_roles(member.guild)
+    mapped_roles = set(roles.values())
+    satisfied_role_names, _ = threshold_index.satisfied(coin_balances)
+    target_roles = {roles[name] for name in satisfied_role_names if name in roles}
+    current_roles = set(member.roles)
+    if not revoke:
+        target_roles |= mapped_roles & current_roles
+
+    # one add per satisfied mapping and one remove per stale role is what a per-mapping sync costs
+    per_mapping_calls = len(target_roles) + len(
+        (mapped_roles - target_roles) & current_roles
+    )
+
+    mutation = MemberRolesMutation(member, mapped_roles, target_roles)
+    if not mutation.pending():
+        return 0, per_mapping_calls
+
+    if scheduler is not None:
+        scheduler.submit(mutation)
     else:
-        print("Channel not found")
+        await mutation.apply()
+    return 1, per_mapping_calls - 1
+
+
+async def reconcile_channel_overwrites(
+    threshold_index, guild, member_balances, scheduler=None, grant_only=()
+):
+    """
+    Bring the member overwrites of every mapped channel in line with the channel mappings.
+
+    The overwrite map of a channel is built from all eligible members at once
+    and compared with channel.overwrites. A single changed member is sent with
+    set_permissions, several are merged into one channel.edit call and channels
+    without changes aren't touched.
+
+    @param threshold_index: ThresholdIndex of the guild
+    @param guild: discord.Guild the mappings belong to
+    @param member_balances: list of (discord.Member, dict of coin -> balance) of linked members
+    @param scheduler: MutationScheduler to queue the edits on, applied right away if None
+    @param grant_only: members whose access is only granted, for balances that may be outdated
+    @return: tuple of (edits sent, overwrite mutations skipped compared to one call per member)
+    """
+    if not threshold_index.channel_names:
+        return 0, 0
+
+    satisfied_channels = [
+        (member, threshold_index.satisfied(coin_balances)[1])
+        for member, coin_balances in member_balances
+        if coin_balances is not None
+    ]
+
+    edits = 0
+    skipped = 0
+    for channel_name in threshold_index.channel_names:
+        channel = get(guild.channels, name=channel_name)
+        if channel is None:
+            print("Channel not found")
+            continue
+
+        overwrites = channel.overwrites
+        changed = {}
+        for member, channel_names in satisfied_channels:
+            allowed = channel_name in channel_names
+            if not allowed and member in grant_only:
+                continue
 
+            current = overwrites.get(member)
+            desired = (
+                discord.PermissionOverwrite.from_pair(*current.pair())
+                if current is not None
+                else discord.PermissionOverwrite()
+            )
+            desired.update(
+                send_messages=allowed,
+                read_messages=allowed,
+                read_message_history=allowed,
+            )
+            if desired != current:
+                changed[member] = desired
+
+        if not changed:
+            skipped += len(satisfied_channels)
+            continue
+
+        mutation = ChannelOverwritesMutation(channel, changed)
+        if scheduler is not None:
+            scheduler.submit(mutation)
+        else:
+            await mutation.apply()
 
-async def grant_deny_role_to_member(role_mapping, member, balances):
+        edits += 1
+        skipped += len(satisfied_channels) - 1
+
+    return edits, skipped
+
+
+async def fetch_many(fetch, keys, concurrency):
     """
-    Determine if the rally_id and balance for a role is still valid for a particular member
-    Update status in database.
+    Run an async Rally request for many keys concurrently.
 
-    Parameters
-    __________
+    Requests go through the pooled connections of rally_api.client and at
+    most `concurrency` of them are in flight at any time, so the event loop
+    keeps serving the discord gateway while the responses are downloaded.
+
+    @param fetch: coroutine function taking a key
+    @param keys: iterable of keys to fetch
+    @param concurrency: maximum number of requests in flight
+    @return: dict of key -> response (None if the request failed)
+    """
+    semaphore = asyncio.Semaphore(concurrency)
 
-      channel_mapping (list) - list of information for the channel mapped to the member
-      member (discord.Member) - The discord member to check
-      balances (list)  - The amount allocated to this member per coin
+    async def fetch_one(key):
+        async with semaphore:
+            try:
+                return key, await fetch(key)
+            except rally_api.RallyAPIError as e:
+                print(e)
+                return key, None
 
+    results = await asyncio.gather(*[fetch_one(key) for key in set(keys)])
+    return dict(results)
+
+
+async def fetch_balances(rally_ids, concurrency):
+    """
+    Fetch the balances of many rally ids concurrently.
+
+    @param rally_ids: iterable of rally ids to fetch
+    @param concurrency: maximum number of requests in flight
+    @return: dict of rally id -> balances (None if the request failed)
+    """
+    return await fetch_many(rally_api.client.get_balances, rally_ids, concurrency)
+
+
+async def backfill_rally_usernames(concurrency):
     """
+    Store the rally usernames of linked accounts that don't have one yet.
+
+    Webhook events only carry usernames, so accounts linked before usernames
+    were stored can't be resynced from them until this has run.
 
-    rally_id = data.get_rally_id(member.id)
-    if rally_id is None or balances is None:
+    @param concurrency: maximum number of requests in flight
+    """
+    rally_ids = data.get_rally_ids_without_username(USERNAME_BACKFILL_LIMIT)
+    if not rally_ids:
         return
-    role_to_assign = get(member.guild.roles, name=role_mapping[data.ROLE_NAME_KEY])
-    if (
-            rally_api.find_balance_of_coin(role_mapping[data.COIN_KIND_KEY], balances)
-            >= role_mapping[data.REQUIRED_BALANCE_KEY]
+
+    await sync_budget.wait()
+    users = await fetch_many(rally_api.client.get_user, rally_ids, concurrency)
+    sync_budget.record("rally", len(rally_ids))
+    usernames = {
+        rally_id: user[USERNAME_KEY]
+        for rally_id, user in users.items()
+        if user and user.get(USERNAME_KEY)
+    }
+    data.set_rally_usernames(usernames)
+    # ids that failed or have no username don't hold up the others until they're due again
+    data.set_usernames_checked(rally_ids)
+    print(f"Stored {len(usernames)} rally usernames")
+
+
+class LastKnownBalances(list):
+    """
+    Balances of a rally id loaded from the balance store after its request failed.
+
+    Roles and channels may be granted from them, but nothing is revoked until
+    fresh balances are fetched.
+
+    @param fetched_at: time the balances were fetched from Rally
+    """
+
+    def __init__(self, balances, fetched_at):
+        super().__init__(balances)
+        self.fetched_at = fetched_at
+
+
+class BalanceTable:
+    """
+    Balances of rally ids fetched by recent guild syncs.
+
+    One table is shared by every guild sync and every bot instance in
+    running_bots. A guild sync reuses every balance fetched since the
+    guild's previous sync, so a rally id is requested from Rally about once
+    per sync interval no matter how many guilds its discord account is in,
+    and a guild never syncs from balances older than its previous sync.
+    Entries are kept at most `max_age` seconds, failed requests are never
+    stored.
+
+    Fetched balances are also written to the balance store, so other
+    processes and restarts reuse them the same way, unless `store` is False.
+    When a request fails the stored balances are returned as
+    LastKnownBalances if they are younger than the balance_max_staleness
+    config.
+    """
+
+    def __init__(self, max_age=SCHEDULE_MAX_INTERVAL, store=True):
+        self.max_age = max_age
+        self.store = store
+        self.balances = {}
+        self.pending = {}
+        self.hits = 0
+        self.misses = 0
+        self.fallbacks = 0
+
+    def prune(self):
+        """Drop entries that are older than max_age."""
+        now = time.time()
+        expired = [
+            rally_id
+            for rally_id, (fetched_at, _) in self.balances.items()
+            if now - fetched_at >= self.max_age
+        ]
+        for rally_id in expired:
+            del self.balances[rally_id]
+
+    async def get_many(
+        self, rally_ids, concurrency=None, refresh=False, fresh_after=None
     ):
-        if role_to_assign is not None:
-            await member.add_roles(role_to_assign)
-            print("Assigned role to member")
+        """
+        Get the balances of many rally ids, fetching only the missing ones.
+
+        @param rally_ids: iterable of rally ids
+        @param concurrency: maximum number of requests in flight, defaults to config
+        @param refresh: ignore stored entries and fetch every rally id again
+        @param fresh_after: time balances must have been fetched after to be reused,
+            usually the guild's previous sync, SCHEDULE_MIN_INTERVAL seconds ago if None
+        @return: dict of rally id -> balances, LastKnownBalances if the request
+            failed and the stored ones are recent enough, None otherwise
+        """
+        if concurrency is None:
+            concurrency = int(config.CONFIG.balance_concurrency)
+
+        now = time.time()
+        if fresh_after is None:
+            fresh_after = now - SCHEDULE_MIN_INTERVAL
+        fresh_after = max(fresh_after, now - self.max_age)
+        result = {}
+        waiting = {}
+        missing = []
+
+        for rally_id in set(rally_ids):
+            entry = self.balances.get(rally_id)
+            if rally_id in self.pending:
+                # another guild or bot instance is already fetching it
+                self.hits += 1
+                waiting[rally_id] = self.pending[rally_id]
+            elif not refresh and entry and entry[0] > fresh_after:
+                self.hits += 1
+                result[rally_id] = entry[1]
+            else:
+                missing.append(rally_id)
+                self.pending[rally_id] = asyncio.get_event_loop().create_future()
+
+        loaded = {}
+        try:
+            if missing:
+                loaded = await self.load(missing, concurrency, refresh, fresh_after)
+        finally:
+            for rally_id in missing:
+                self.pending.pop(rally_id).set_result(loaded.get(rally_id))
+
+        result.update(loaded)
+        for rally_id, future in waiting.items():
+            result[rally_id] = await future
+
+        return result
+
+    async def load(self, rally_ids, concurrency, refresh, fresh_after):
+        """
+        Get balances from the balance store if they were fetched after
+        fresh_after, by another process or before a restart, and from Rally
+        otherwise.
+
+        @return: dict of rally id -> balances, LastKnownBalances or None
+        """
+        snapshots = data.get_balance_snapshots(rally_ids) or {}
+        result = {}
+        missing = []
+        for rally_id in rally_ids:
+            snapshot = snapshots.get(rally_id)
+            if not refresh and snapshot and snapshot[1] > fresh_after:
+                self.hits += 1
+                self.balances[rally_id] = (snapshot[1], snapshot[0])
+                result[rally_id] = snapshot[0]
+            else:
+                missing.append(rally_id)
+        if not missing:
+            return result
+
+        self.misses += len(missing)
+        fetched = await fetch_balances(missing, concurrency)
+        fetched_at = time.time()
+        max_staleness = int(config.CONFIG.balance_max_staleness)
+
+        new_snapshots = {}
+        for rally_id in missing:
+            balances = fetched.get(rally_id)
+            snapshot = snapshots.get(rally_id)
+            if balances is not None:
+                self.balances[rally_id] = (fetched_at, balances)
+                new_snapshots[rally_id] = (balances, fetched_at)
+                result[rally_id] = balances
+            elif snapshot and fetched_at - snapshot[1] < max_staleness:
+                self.fallbacks += 1
+                result[rally_id] = LastKnownBalances(snapshot[0], snapshot[1])
+            else:
+                result[rally_id] = None
+
+        if new_snapshots and self.store:
+            data.set_balance_snapshots(new_snapshots)
+        return result
+
+    async def get(self, rally_id, refresh=False):
+        """
+        Get the balances of a single rally id.
+
+        @param rally_id: rally id of the user
+        @param refresh: ignore a stored entry and fetch it again
+        @return: balances, LastKnownBalances or None like get_many
+        """
+        balances = await self.get_many([rally_id], concurrency=1, refresh=refresh)
+        return balances[rally_id]
+
+
+class ResyncQueue:
+    """
+    Priority queue of rally ids whose members need to be re-evaluated right away.
+
+    A rally id that is already queued isn't queued again, its coins are merged
+    into the pending entry instead.
+    """
+
+    def __init__(self):
+        self.queue = None
+        self.pending = {}
+        self.counter = itertools.count()
+
+    def __len__(self):
+        return len(self.pending)
+
+    def push(self, rally_id, coins, priority=RESYNC_PRIORITY_WEBHOOK):
+        """
+        Queue a rally id for a resync.
+
+        @param rally_id: rally id whose members should be resynced
+        @param coins: coins whose mappings should be re-evaluated
+        @param priority: lower values are resynced first
+        """
+        if self.queue is None:
+            self.queue = asyncio.PriorityQueue()
+
+        if rally_id in self.pending:
+            self.pending[rally_id].update(coins)
         else:
-            print("Can't find role")
-            print(role_mapping["role"])
+            self.pending[rally_id] = set(coins)
+            self.queue.put_nowait((priority, next(self.counter), rally_id))
+
+    async def pop(self):
+        """
+        Wait for the most urgent queued rally id.
+
+        @return: tuple of (rally id, set of coins)
+        """
+        if self.queue is None:
+            self.queue = asyncio.PriorityQueue()
+
+        _, _, rally_id = await self.queue.get()
+        return rally_id, self.pending.pop(rally_id)
+
+
+class MemberIndex:
+    """
+    Guild membership kept up to date from gateway member events.
+
+    Guild member lists are only downloaded again with guild.chunk() when a
+    gap is detected, i.e. the client cache of the guild isn't chunked. A new
+    session after a failed resume rebuilds the index from the cache. Members
+    that joined or whose roles changed are marked dirty so the next update
+    evaluates them even if their balances didn't change.
+    """
+
+    def __init__(self):
+        self.guilds_by_member = {}
+        self.indexed_guilds = set()
+        self.dirty = {}
+        self.chunk_calls = 0
+
+    def add(self, member):
+        self.guilds_by_member.setdefault(member.id, set()).add(member.guild.id)
+
+    def remove(self, member):
+        guild_ids = self.guilds_by_member.get(member.id)
+        if guild_ids is not None:
+            guild_ids.discard(member.guild.id)
+            if not guild_ids:
+                del self.guilds_by_member[member.id]
+        self.dirty.get(member.guild.id, set()).discard(member.id)
+
+    def mark_dirty(self, member):
+        self.dirty.setdefault(member.guild.id, set()).add(member.id)
+
+    def is_dirty(self, member):
+        """
+        @return: True if the member must be evaluated even if its balances didn't change
+        """
+        return member.id in self.dirty.get(member.guild.id, ())
+
+    def clear_dirty(self, member):
+        """Forget the dirty mark of a member that is being evaluated."""
+        dirty = self.dirty.get(member.guild.id)
+        if dirty is not None:
+            dirty.discard(member.id)
+            if not dirty:
+                del self.dirty[member.guild.id]
+
+    def guild_ids(self, member_id):
+        """
+        @return: ids of the indexed guilds the member is in
+        """
+        return set(self.guilds_by_member.get(member_id, ()))
+
+    def mutual_guilds(self, guilds, member_id):
+        """
+        Find the guilds a member is in without scanning member lists.
+
+        Indexed guilds are looked up in the index, guilds that weren't indexed
+        yet in the client cache with guild.get_member.
+
+        @param guilds: guilds of the bot
+        @param member_id: discord id of the member
+        @return: list of (guild, discord.Member)
+        """
+        indexed_guild_ids = self.guild_ids(member_id)
+        mutual = []
+        for guild in guilds:
+            if guild.id in self.indexed_guilds and guild.id not in indexed_guild_ids:
+                continue
+            member = guild.get_member(member_id)
+            if member is not None:
+                mutual.append((guild, member))
+        return mutual
+
+    def invalidate(self, guilds):
+        """Forget these guilds and rebuild their index from the client cache on next use."""
+        guild_ids = {guild.id for guild in guilds}
+        for member_id in list(self.guilds_by_member):
+            self.guilds_by_member[member_id] -= guild_ids
+            if not self.guilds_by_member[member_id]:
+                del self.guilds_by_member[member_id]
+        self.indexed_guilds -= guild_ids
+
+    async def ensure_complete(self, guild):
+        """
+        Make sure the member list of a guild is complete and indexed, chunking only if needed.
+
+        @param guild: discord.Guild
+        """
+        if not guild.chunked:
+            await guild.chunk()
+            self.chunk_calls += 1
+            self.indexed_guilds.discard(guild.id)
+
+        if guild.id not in self.indexed_guilds:
+            for member in guild.members:
+                self.add(member)
+            self.indexed_guilds.add(guild.id)
+
+
+class PendingFingerprints:
+    """
+    Balance fingerprints of members whose edits are still queued.
+
+    A fingerprint makes later syncs skip its member, so it is only stored
+    once every queued edit of the member was applied. Queued edits are lost
+    on a restart, the fingerprints kept here with them, and the member is
+    evaluated again by the next sync.
+    """
+
+    def __init__(self):
+        # (guild id, member id) -> (rally id, fingerprint)
+        self.fingerprints = {}
+
+    def store(self, guild_id, member_fingerprints, scheduler):
+        """
+        Store the fingerprints of members without queued edits, keep the others.
+
+        @param guild_id: id of the guild
+        @param member_fingerprints: list of (discord.Member, rally id, fingerprint)
+        @param scheduler: MutationScheduler the member edits were queued on
+        """
+        settled = {}
+        for member, rally_id, fingerprint in member_fingerprints:
+            if scheduler.is_pending(member):
+                self.fingerprints[(guild_id, member.id)] = (rally_id, fingerprint)
+            else:
+                self.fingerprints.pop((guild_id, member.id), None)
+                settled[rally_id] = fingerprint
+        if settled:
+            data.set_balance_fingerprints(guild_id, settled)
+
+    def settled(self, members):
+        """Store the kept fingerprints of members whose queued edits were all applied."""
+        settled = {}
+        for member in members:
+            entry = self.fingerprints.pop((member.guild.id, member.id), None)
+            if entry is not None:
+                rally_id, fingerprint = entry
+                settled.setdefault(member.guild.id, {})[rally_id] = fingerprint
+        for guild_id, fingerprints in settled.items():
+            data.set_balance_fingerprints(guild_id, fingerprints)
+
+    def discard(self, member):
+        self.fingerprints.pop((member.guild.id, member.id), None)
+
+
+class CallBudget:
+    """
+    Rolling one minute budget of the Rally requests and discord edits of all processes.
+
+    The limits are --rally_calls_per_minute and --discord_calls_per_minute,
+    0 disables a limit. Calls are counted per minute in the call_budget table,
+    so the bot and every sync worker share one budget, and the last minute is
+    estimated from the current and the previous window. A process writes its
+    calls every CALL_BUDGET_FLUSH_TIME seconds. Every call is recorded, only
+    scheduled updates wait before every batch until the budget has room.
+    """
+
+    kinds = ("rally", "discord")
+
+    def __init__(self):
+        self.unflushed = Counter()
+        self.flushed = time.monotonic()
+
+    def limit(self, kind):
+        return int(getattr(config.CONFIG, f"{kind}_calls_per_minute"))
+
+    def record(self, kind, count):
+        self.unflushed[kind] += count
+        if time.monotonic() - self.flushed >= CALL_BUDGET_FLUSH_TIME:
+            self.flush()
+
+    def flush(self):
+        """Add the calls recorded since the last write to the shared windows."""
+        window_start = int(time.time() // 60 * 60)
+        for kind, count in self.unflushed.items():
+            if count:
+                data.add_budget_calls(kind, window_start, count)
+        self.unflushed.clear()
+        self.flushed = time.monotonic()
+
+    def used(self, kind):
+        """
+        @return: calls of a kind by every process in about the last minute
+        """
+        self.flush()
+        now = time.time()
+        window_start = int(now // 60 * 60)
+        calls = data.get_budget_calls(kind, [window_start - 60, window_start])
+        # the previous window counts for the part of it still in the last minute
+        previous_share = 1 - (now - window_start) / 60
+        return int(
+            calls.get(window_start - 60, 0) * previous_share
+            + calls.get(window_start, 0)
+        )
+
+    async def wait(self):
+        """Wait until every limited kind of call is under its budget."""
+        for kind in self.kinds:
+            limit = self.limit(kind)
+            while limit > 0 and self.used(kind) >= limit:
+                await asyncio.sleep(CALL_BUDGET_POLL_TIME)
+
+
+def sync_interval(
+    previous_interval, churn, balance_changes, webhook_events, linked_members
+):
+    """
+    Seconds a guild waits for its next full sync.
+
+    Active guilds, by balance churn and webhook events, are synced up to
+    1 + SCHEDULE_ACTIVITY_WEIGHT times faster than UPDATE_WAIT_TIME, large
+    guilds less often but never less often than UPDATE_WAIT_TIME while they
+    are active. Guilds without balance changes or webhook events in this
+    sync double their interval.
+
+    @param previous_interval: interval of the guild's last sync
+    @param churn: average share of linked members whose balances changed
+    @param balance_changes: members whose balances changed in this sync
+    @param webhook_events: webhook events for the guild since its last sync
+    @param linked_members: linked members in the guild
+    @return: interval between SCHEDULE_MIN_INTERVAL and SCHEDULE_MAX_INTERVAL
+    """
+    activity = churn + min(webhook_events / SCHEDULE_WEBHOOK_EVENTS, 1.0)
+    # the smoothed churn only approaches 0, idleness is decided by this sync alone
+    if balance_changes == 0 and webhook_events == 0:
+        interval = previous_interval * 2
     else:
-        if role_to_assign in member.roles:
-            await member.remove_roles(role_to_assign)
-            print("Removed role to member")
+        size_factor = max(1.0, linked_members / SCHEDULE_MEMBERS_REFERENCE) ** 0.5
+        # the size only reduces the speed up, an active guild is synced at least as
+        # often as with the fixed UPDATE_WAIT_TIME
+        interval = min(
+            UPDATE_WAIT_TIME * size_factor / (1 + SCHEDULE_ACTIVITY_WEIGHT * activity),
+            UPDATE_WAIT_TIME,
+        )
+    return min(max(interval, SCHEDULE_MIN_INTERVAL), SCHEDULE_MAX_INTERVAL)
+
+
+class GuildSyncScheduler:
+    """
+    Picks the guilds of a bot that are due for a sync.
+
+    A guild is due sync_interval seconds after its last full sync, both
+    stored in guild_sync_status so restarts and sync workers share them.
+    Guilds without a status are due right away. Guilds forced with the
+    update command come before every due guild.
+    """
+
+    def __init__(self):
+        self.forced = OrderedDict()
+        self.wakeup = None
+
+    def force(self, guild_id):
+        """
+        Sync a guild as soon as the current guild is done.
+
+        @param guild_id: id of the guild
+        """
+        self.forced.setdefault(guild_id, time.time())
+        if self.wakeup is not None:
+            self.wakeup.set()
+
+    async def wait(self, timeout):
+        """Sleep until timeout or until a guild is forced."""
+        if self.wakeup is None:
+            self.wakeup = asyncio.Event()
+        if not self.forced:
+            try:
+                await asyncio.wait_for(self.wakeup.wait(), timeout)
+            except asyncio.TimeoutError:
+                pass
+        self.wakeup.clear()
+
+    def pop_forced(self, guilds):
+        """
+        @param guilds: dict of guild id -> guild of the bot
+        @return: tuple of (guild, time it was forced) or None
+        """
+        while self.forced:
+            guild_id, forced_at = self.forced.popitem(last=False)
+            if guild_id in guilds:
+                return guilds[guild_id], forced_at
+        return None
+
+    def due_guilds(self, guilds, statuses):
+        """
+        @param guilds: dict of guild id -> guild of the bot
+        @param statuses: dict of guild id -> guild_sync_status row
+        @return: list of (guild, time since which it hasn't been synced), most overdue first
+        """
+        now = time.time()
+        due = []
+        for guild in guilds.values():
+            status = statuses.get(guild.id)
+            if status is None or status[LAST_FULL_SYNC_KEY] is None:
+                due.append((0.0, guild, now))
+                continue
+
+            interval = status[SYNC_INTERVAL_KEY] or UPDATE_WAIT_TIME
+            due_at = status[LAST_FULL_SYNC_KEY] + interval
+            if due_at <= now:
+                due.append((due_at, guild, now - interval))
+
+        due.sort(key=lambda entry: entry[0])
+        return [(guild, synced_before) for _, guild, synced_before in due]
+
+
+def get_bot_for_guild(guild_id):
+    """
+    Get the bot that manages a guild, the guild's bot instance if it has one.
+
+    @param guild_id: id of the guild
+    @return: bot object
+    """
+    bot_instance = data.get_bot_instance(guild_id)
+    if bot_instance and bot_instance[BOT_ID_KEY] in running_bots:
+        return running_bots[bot_instance[BOT_ID_KEY]]["bot"]
+    return main_bot
+
+
+# shared between all guilds and bot instances
+balance_table = BalanceTable()
+resync_queue = ResyncQueue()
+member_index = MemberIndex()
+pending_fingerprints = PendingFingerprints()
+sync_budget = CallBudget()
+
+
+def mutation_failed(member):
+    """Evaluate a member whose edit failed again on the next update."""
+    member_index.mark_dirty(member)
+    pending_fingerprints.discard(member)
+
+
+def record_discord_calls(count):
+    sync_budget.record("discord", count)
+
+
+mutation_scheduler = MutationScheduler(
+    on_failure=mutation_failed,
+    on_settled=pending_fingerprints.settled,
+    on_calls=record_discord_calls,
+)
+
+
+def record_rally_status(breaker):
+    """Store the Rally circuit breaker state of this process for the API."""
+    data.set_api_status("rally", config.CONFIG.worker_id, breaker.snapshot())
+
+
+rally_api.client.breaker.on_change = record_rally_status
+
+
+async def plan_guild(guild, concurrency=None):
+    """
+    Dry run of the sync of a guild.
+
+    Every linked member is evaluated like in an update, but the role and
+    overwrite edits are recorded instead of sent. Balances and linked
+    accounts are loaded into local tables, so the next update finds the
+    shared balance table, balance store, rally_connections, fingerprints and
+    dirty marks as they were.
+
+    @param guild: discord.Guild to plan
+    @param concurrency: maximum number of balance requests in flight, defaults to config
+    @return: report dict with the diffs and a chunk, db, rally and evaluation timing breakdown
+    """
+    if concurrency is None:
+        concurrency = int(config.CONFIG.balance_concurrency)
+    timings = Counter()
+    plan_start = time.monotonic()
+
+    phase_start = time.monotonic()
+    await member_index.ensure_complete(guild)
+    timings["chunk"] += time.monotonic() - phase_start
+
+    phase_start = time.monotonic()
+    rally_connections = data.get_rally_connections()
+    threshold_index = ThresholdIndex(
+        data.get_role_mappings(guild.id), data.get_channel_mappings(guild.id)
+    )
+    timings["db"] += time.monotonic() - phase_start
+
+    linked_members = []
+    for member in guild.members:
+        rally_id = rally_connections.get(member.id)
+        if rally_id:
+            linked_members.append((member, rally_id))
+
+    phase_start = time.monotonic()
+    plan_balances = BalanceTable(store=False)
+    guild_balances = await plan_balances.get_many(
+        [rally_id for _, rally_id in linked_members], concurrency
+    )
+    balance_requests = plan_balances.misses
+    timings["rally"] += time.monotonic() - phase_start
+
+    phase_start = time.monotonic()
+    plan = MutationPlan()
+    member_balances = []
+    stale_members = set()
+    failed_balances = 0
+    for member, rally_id in linked_members:
+        balances = guild_balances[rally_id]
+        if balances is None:
+            failed_balances += 1
+            continue
+
+        fresh = not isinstance(balances, LastKnownBalances)
+        if not fresh:
+            stale_members.add(member)
+        coin_balances = rally_api.balances_by_coin(balances)
+        member_balances.append((member, coin_balances))
+        await reconcile_member_roles(
+            threshold_index, member, coin_balances, plan, fresh
+        )
+
+    await reconcile_channel_overwrites(
+        threshold_index, guild, member_balances, plan, stale_members
+    )
+    role_diffs = plan.role_diffs()
+    channel_diffs = plan.channel_diffs()
+    timings["evaluation"] += time.monotonic() - phase_start
+    timings["total"] = time.monotonic() - plan_start
+
+    return {
+        "guildId": str(guild.id),
+        "timeCreated": time.time(),
+        "members": guild.member_count,
+        "linkedMembers": len(linked_members),
+        "evaluated": len(member_balances),
+        "failedBalances": failed_balances,
+        "staleBalances": len(stale_members),
+        "balanceRequests": balance_requests,
+        "mappings": len(threshold_index),
+        "timings": {phase: round(seconds, 3) for phase, seconds in timings.items()},
+        "roleDiffs": role_diffs,
+        "channelDiffs": channel_diffs,
+    }
 
 
 async def force_update(bot, ctx):
@@ -348,6 +1233,7 @@ class UpdateTask(commands.Cog):
         self.bot = bot
         self.update_lock = threading.Lock()
         self.task_run_lock = threading.Lock()
+        self.guild_scheduler = GuildSyncScheduler()
 
     async def run_old_timers(self):
         """Starts up old timers that werent finished when the bot was closed."""
@@ -386,7 +1272,7 @@ class UpdateTask(commands.Cog):
 
         # delete timer
         data.delete_timer(timer['id'])
-        
+
         # dispatch event
         self.bot.dispatch(f'{timer["event"]}_timer_over', timer)
 
@@ -400,7 +1286,7 @@ class UpdateTask(commands.Cog):
         @param extras: extra values
         @param bot_id: bot id
         """
-        
+
         timer = {
             'guild_id': guild_id,
             'expires': expires,
@@ -408,7 +1294,7 @@ class UpdateTask(commands.Cog):
             'extras': extras,
             'bot_id': bot_id
         }
-        
+
         timer_id = data.add_timer(timer)
         timer['id'] = timer_id
         asyncio.create_task(self.run_timer(timer))
@@ -422,22 +1308,29 @@ class UpdateTask(commands.Cog):
         """
         # delete week old stats
         data.delete_week_old_events()
-        
+
         # gather some needed data
         guild_id = timer['guild_id']
         channel_name = timer['extras']['channel_name']
         webhook_url = await get_webhook_url(guild_id, channel_name)
         default_coin = data.get_default_coin(int(guild_id))
-        
+
         # check if there is a webhook url to send stats to
+        total_stats = None
         if webhook_url:
+            try:
+                total_stats = await rally_api.client.get_coin_summary(default_coin)
+                rewards = await rally_api.client.get_coin_rewards(default_coin)
+            except rally_api.RallyAPIError as e:
+                # no stats today, the timer is still started again below
+                print(e)
+
+        if total_stats:
             # gather stats data
             coin_day_stats = get_day_stats(default_coin)
-            total_stats = rally_api.get_coin_summary(default_coin)
-            rewards = rally_api.get_coin_rewards(default_coin)
-            
+
             # create stats message
-            coin_image_url = rally_api.get_coin_image_url(default_coin)
+            coin_image_url = await rally_api.catalogue.image_url(default_coin)
             message = {
                 "embeds": [
                     {
@@ -524,6 +1417,23 @@ class UpdateTask(commands.Cog):
 
     @commands.Cog.listener()
     async def on_ready(self):
+        global main_bot
+        # on_ready fires again for every new session, loops started by the first one keep running
+        first_ready = not self.update.is_running()
+
+        # sync workers only take part in the update cycle
+        if config.CONFIG.sync_worker:
+            member_index.invalidate(self.bot.guilds)
+            print(f"Sync worker {config.CONFIG.worker_id} logged in as {self.bot.user}")
+            if first_ready:
+                self.update.start()
+            return
+
+        # a second ready means the session couldn't be resumed and member events were missed
+        if self.bot.user.id in running_bots:
+            print(f"{self.bot.user} started a new session, reindexing members")
+        member_index.invalidate(self.bot.guilds)
+
         running_bots[self.bot.user.id] = {
             'bot': self.bot,
             'token': self.bot.http.token,
@@ -544,13 +1454,19 @@ class UpdateTask(commands.Cog):
             data.set_bot_name(bot_instance[GUILD_ID_KEY], self.bot.user.name)
 
         # for the main bot
-        if not running_bot_instances:
-            global main_bot
+        if not running_bot_instances and main_bot is None:
             main_bot = self.bot
             asyncio.create_task(self.run_bot_instances())
-            self.run_tasks.start()
+            coingecko_api.coin_index.start()
+        if self.bot is main_bot:
+            if not self.run_tasks.is_running():
+                self.run_tasks.start()
+            if not self.resync.is_running():
+                self.resync.start()
 
         print("We have logged in as {0.user}".format(self.bot))
+        if not first_ready:
+            return
         self.update.start()
 
         if not default_avatar:
@@ -558,6 +1474,22 @@ class UpdateTask(commands.Cog):
 
         await self.run_old_timers()
 
+    @commands.Cog.listener()
+    async def on_member_join(self, member):
+        member_index.add(member)
+        member_index.mark_dirty(member)
+
+    @commands.Cog.listener()
+    async def on_member_remove(self, member):
+        member_index.remove(member)
+
+    @commands.Cog.listener()
+    async def on_member_update(self, before, after):
+        # roles edited by someone else are corrected on the next update, the bot's own
+        # edits would only make the member look changed
+        if before.roles != after.roles and not MemberRolesMutation.caused_update(after):
+            member_index.mark_dirty(after)
+
     @errors.standard_error_handler
     async def cog_command_error(self, ctx, error):
         # All other Errors not returned come here. And we can just print the default TraceBack.
@@ -566,12 +1498,102 @@ class UpdateTask(commands.Cog):
             type(error), error, error.__traceback__, file=sys.stderr
         )
 
-    @commands.command(name="update", help="Force an immediate update")
+    @commands.command(name="update", help="Update roles in this server right away")
+    @commands.guild_only()
     @validation.owner_or_permissions(administrator=True)
     async def force_update(self, ctx):
-        self.update.restart()
+        self.guild_scheduler.force(ctx.guild.id)
         await ctx.send("Updating!")
 
+    @commands.command(
+        name="sync_status", help="Show when roles were last fully synced in this server"
+    )
+    @commands.guild_only()
+    @validation.owner_or_permissions(administrator=True)
+    async def sync_status(self, ctx):
+        status = data.get_guild_sync_status(ctx.guild.id)
+        if not status or status[LAST_FULL_SYNC_KEY] is None:
+            return await pretty_print(
+                ctx,
+                "This server hasn't been fully synced yet",
+                title="Sync status",
+                color=WARNING_COLOR,
+            )
+
+        last_full_sync = status[LAST_FULL_SYNC_KEY]
+        synced_at = datetime.datetime.utcfromtimestamp(last_full_sync)
+        minutes_ago = int((time.time() - last_full_sync) // 60)
+        interval = status[SYNC_INTERVAL_KEY] or UPDATE_WAIT_TIME
+        await pretty_print(
+            ctx,
+            f"Last full sync: {synced_at:%Y-%m-%d %H:%M} UTC ({minutes_ago} minutes ago)\n"
+            f"Synced every {int(interval // 60)} minutes",
+            title="Sync status",
+            color=SUCCESS_COLOR,
+        )
+
+    @commands.command(
+        name="plan",
+        help="Show the role and channel changes the next update would make, without making them",
+    )
+    @commands.guild_only()
+    @validation.owner_or_permissions(administrator=True)
+    async def plan(self, ctx):
+        async with ctx.typing():
+            report = await plan_guild(ctx.guild)
+        data.set_sync_plan(ctx.guild.id, report)
+
+        timings = report["timings"]
+        role_lines = [
+            f"{diff['member']}: "
+            + ", ".join(
+                [f"+{role}" for role in diff["add"]]
+                + [f"-{role}" for role in diff["remove"]]
+            )
+            for diff in report["roleDiffs"]
+        ]
+        channel_lines = [
+            f"#{diff['channel']}: {len(diff['allow'])} allowed, {len(diff['deny'])} denied"
+            for diff in report["channelDiffs"]
+        ]
+
+        def shown(lines):
+            if not lines:
+                return "No changes"
+            text = "\n".join(lines[:PLAN_DIFFS_SHOWN])
+            if len(lines) > PLAN_DIFFS_SHOWN:
+                text += f"\n... and {len(lines) - PLAN_DIFFS_SHOWN} more"
+            # embed field values are limited to 1024 characters
+            return text[:1024]
+
+        await pretty_print(
+            ctx,
+            [
+                [
+                    "Members",
+                    f"{report['linkedMembers']} linked, {report['evaluated']} evaluated, "
+                    f"{report.get('staleBalances', 0)} from last known balances, "
+                    f"{report['failedBalances']} without balances",
+                    False,
+                ],
+                [
+                    "Timings",
+                    f"chunk {timings['chunk']:.2f}s, db {timings['db']:.2f}s, "
+                    f"rally {timings['rally']:.2f}s ({report['balanceRequests']} requests), "
+                    f"evaluation {timings['evaluation']:.2f}s, total {timings['total']:.2f}s",
+                    False,
+                ],
+                [f"Role changes ({len(role_lines)})", shown(role_lines), False],
+                [
+                    f"Channel changes ({len(channel_lines)})",
+                    shown(channel_lines),
+                    False,
+                ],
+            ],
+            title="Update plan",
+            color=SUCCESS_COLOR,
+        )
+
     @discord_tasks.loop(seconds=5)
     async def run_tasks(self):
         await self.bot.wait_until_ready()
@@ -591,50 +1613,430 @@ class UpdateTask(commands.Cog):
                 except Exception as e:
                     print(e)
 
-    @discord_tasks.loop(seconds=UPDATE_WAIT_TIME)
+    @discord_tasks.loop(seconds=0)
+    async def resync(self):
+        """Re-evaluate members queued by webhook events as soon as they arrive."""
+        await self.bot.wait_until_ready()
+        rally_id, coins = await resync_queue.pop()
+        try:
+            await self.resync_rally_id(rally_id, coins)
+        except Exception as e:
+            print(f"Failed to resync {rally_id}: {e}")
+
+    async def resync_rally_id(self, rally_id, coins):
+        """
+        Re-evaluate the members linked to a rally id in the guilds that map the given coins.
+
+        @param rally_id: rally id whose balances changed
+        @param coins: coins that changed
+        """
+        # from the database, rally_connections is only loaded by processes that run updates
+        discord_ids = data.get_discord_ids(rally_id)
+        if not discord_ids:
+            return
+
+        balances = await balance_table.get(rally_id, refresh=True)
+        sync_budget.record("rally", 1)
+        # the event means the last known balances are outdated
+        if balances is None or isinstance(balances, LastKnownBalances):
+            return
+        coin_balances = rally_api.balances_by_coin(balances)
+
+        for guild_id in data.get_guild_ids_by_mapped_coin(coins):
+            bot_object = get_bot_for_guild(guild_id)
+            guild = bot_object.get_guild(int(guild_id)) if bot_object else None
+            if guild is None:
+                continue
+
+            threshold_index = ThresholdIndex(
+                data.get_role_mappings(guild.id), data.get_channel_mappings(guild.id)
+            )
+            member_balances = [
+                (member, coin_balances)
+                for member in [
+                    guild.get_member(int(discord_id)) for discord_id in discord_ids
+                ]
+                if member is not None
+            ]
+            if not member_balances:
+                continue
+
+            for member, _ in member_balances:
+                await reconcile_member_roles(
+                    threshold_index, member, coin_balances, mutation_scheduler
+                )
+            await reconcile_channel_overwrites(
+                threshold_index, guild, member_balances, mutation_scheduler
+            )
+
+            fingerprint = balance_fingerprint(threshold_index, coin_balances)
+            pending_fingerprints.store(
+                guild.id,
+                [(member, rally_id, fingerprint) for member, _ in member_balances],
+                mutation_scheduler,
+            )
+            # webhook activity makes the scheduler sync the guild more often
+            data.add_guild_webhook_event(guild.id)
+            print(f"Resynced {rally_id} in {guild.name}")
+
+    @discord_tasks.loop(seconds=0)
     async def update(self):
         await self.bot.wait_until_ready()
+        await self.guild_scheduler.wait(SCHEDULE_TICK)
         with self.update_lock:
 
+            # guilds are always split through leases, so sync workers started at any time
+            # never sync a guild at the same time as this process
+            worker_id = config.CONFIG.worker_id
+            guilds = {guild.id: guild for guild in self.bot.guilds}
+
+            # a guild interrupted by a restart of the bot continues from its checkpoint,
+            # sync workers share the bot's id and leave unfinished guilds to the leases
+            bot_id = self.bot.user.id
+            checkpointed = not config.CONFIG.sync_worker
+            checkpoint = data.get_sync_checkpoint(bot_id) if checkpointed else None
+            if checkpoint and checkpoint[GUILD_ID_KEY] not in guilds:
+                data.clear_sync_checkpoint(bot_id)
+                checkpoint = None
+
+            statuses = data.get_guild_sync_statuses() or {}
+            due_guilds = deque(self.guild_scheduler.due_guilds(guilds, statuses))
+            if not due_guilds and not checkpoint and not self.guild_scheduler.forced:
+                return
+
+            # due guilds stay due until Rally is back, no requests are sent that would fail
+            if not rally_api.client.breaker.allow():
+                return
+
             print("Updating roles")
-            guilds = self.bot.guilds
-            guild_count = 0
-            member_count = 0
-            mapping_count = 0
-
-            for guild in guilds:
-
-                guild_count += 1
-                await guild.chunk()
-
-                role_mappings = list(data.get_role_mappings(guild.id))
-                channel_mappings = list(data.get_channel_mappings(guild.id))
-                mapping_count += len(role_mappings) + len(channel_mappings)
-
-                for member in guild.members:
-                    member_count += 1
-                    rally_id = data.get_rally_id(member.id)
-                    if rally_id:
-                        balances = rally_api.get_balances(rally_id)
-                        for role_mapping in role_mappings:
-                            print(role_mapping)
-                            await grant_deny_role_to_member(
-                                role_mapping, member, balances
-                            )
-                        for channel_mapping in channel_mappings:
-                            await grant_deny_channel_to_member(
-                                channel_mapping, member, balances
-                            )
+            stats = Counter()
+            concurrency = int(config.CONFIG.balance_concurrency)
+            cycle_start = time.monotonic()
+            cycle_started = time.time()
+
+            # one query for every linked account instead of one per member
+            data.load_rally_connections()
+            await backfill_rally_usernames(concurrency)
+            balance_table.prune()
+            chunk_calls_before = member_index.chunk_calls
+            hits_before = balance_table.hits
+            misses_before = balance_table.misses
+            fallbacks_before = balance_table.fallbacks
+
+            resume_guild_id = 0
+            resume_member_id = 0
+            if checkpoint:
+                resume_guild_id = checkpoint[GUILD_ID_KEY]
+                resume_member_id = checkpoint[LAST_MEMBER_ID_KEY]
+                print(
+                    f"Resuming the sync of guild {resume_guild_id} interrupted at "
+                    f"{datetime.datetime.fromtimestamp(checkpoint[CYCLE_STARTED_KEY])}"
+                )
+                due_guilds.appendleft((guilds[resume_guild_id], cycle_started))
+
+            synced = set()
+            rally_down = False
+            while True:
+                if not rally_api.client.breaker.allow():
+                    rally_down = True
+                    break
+
+                # guilds forced with the update command go before every due guild
+                forced = self.guild_scheduler.pop_forced(guilds)
+                if forced:
+                    guild, synced_before = forced
+                    stats["guilds_forced"] += 1
+                elif due_guilds:
+                    guild, synced_before = due_guilds.popleft()
+                    if guild.id in synced:
+                        continue
+                else:
+                    break
+                synced.add(guild.id)
+
+                if not data.acquire_sync_lease(
+                    guild.id, worker_id, SYNC_LEASE_TIME, synced_before
+                ):
+                    stats["guilds_leased_elsewhere"] += 1
+                    continue
 
+                after_member_id = 0
+                if guild.id == resume_guild_id:
+                    after_member_id = resume_member_id
+                    resume_guild_id = 0
+
+                def save_checkpoint(last_member_id, guild_id=guild.id):
+                    if checkpointed:
+                        data.set_sync_checkpoint(
+                            bot_id, cycle_started, guild_id, last_member_id
+                        )
+
+                save_checkpoint(after_member_id)
+                guild_stats = Counter()
+                completed = await self.sync_guild(
+                    guild,
+                    guild_stats,
+                    concurrency,
+                    after_member_id,
+                    save_checkpoint,
+                    (statuses.get(guild.id) or {}).get(LAST_FULL_SYNC_KEY),
+                )
+                stats.update(guild_stats)
+                if not completed:
+                    if not rally_api.client.breaker.allow():
+                        rally_down = True
+                        break
+                    print(f"Lost the sync lease of {guild.name}, skipping it")
+                    continue
+
+                status = statuses.get(guild.id) or {}
+                churn = guild_stats["balance_changes"] / max(
+                    guild_stats["linked_members"], 1
+                )
+                churn = SCHEDULE_CHURN_SMOOTHING * churn + (
+                    1 - SCHEDULE_CHURN_SMOOTHING
+                ) * (status.get(CHURN_KEY) or 0.0)
+                webhook_events = status.get(WEBHOOK_EVENTS_KEY) or 0
+                interval = sync_interval(
+                    status.get(SYNC_INTERVAL_KEY) or UPDATE_WAIT_TIME,
+                    churn,
+                    guild_stats["balance_changes"],
+                    webhook_events,
+                    guild_stats["linked_members"],
+                )
+                data.complete_guild_sync(guild.id, interval, churn, webhook_events)
+                stats["interval_total"] += interval
+
+                data.complete_sync_lease(guild.id, worker_id)
+
+            if rally_down:
+                # the checkpoint is kept, the interrupted guild continues when Rally is back
+                breaker = rally_api.client.breaker.snapshot()
+                print(
+                    f"Rally is unavailable, update stopped until "
+                    f"{datetime.datetime.fromtimestamp(breaker['openUntil'])}. "
+                    f"{len(due_guilds)} due guilds left."
+                )
+            elif checkpointed and not resume_guild_id:
+                # kept while the interrupted guild is still leased by the previous process
+                data.clear_sync_checkpoint(bot_id)
+            record_rally_status(rally_api.client.breaker)
+
+            cycle_time = time.monotonic() - cycle_start
+            fetch_time = stats["fetch_time"]
+            table_hits = balance_table.hits - hits_before
+            request_count = balance_table.misses - misses_before
+            requests_per_second = request_count / fetch_time if fetch_time else 0.0
+            average_interval = (
+                stats["interval_total"] / stats["guilds"] if stats["guilds"] else 0.0
+            )
             print(
                 "Done! Checked "
-                + str(guild_count)
+                + str(stats["guilds"])
                 + " guilds. "
-                + str(mapping_count)
+                + str(stats["mappings"])
                 + " mappings. "
-                + str(member_count)
-                + " members."
+                + str(stats["members"])
+                + " members. "
+                + str(stats["members_evaluated"])
+                + " evaluated, "
+                + str(stats["members_skipped"])
+                + " skipped as unchanged, "
+                + str(stats["members_stale"])
+                + " from last known balances. "
+                + str(member_index.chunk_calls - chunk_calls_before)
+                + " guild chunk calls."
             )
+            print(
+                f"Scheduler: {stats['guilds_forced']} guilds forced, "
+                f"next syncs in {average_interval / 60:.1f} minutes on average. "
+                f"Budget used in the last minute: "
+                f"{sync_budget.used('rally')}/{sync_budget.limit('rally')} rally, "
+                f"{sync_budget.used('discord')}/{sync_budget.limit('discord')} discord."
+            )
+            print(
+                f"Worker {worker_id}: {stats['guilds_leased_elsewhere']} guilds "
+                f"synced or leased by other workers."
+            )
+            print(
+                f"Cycle took {cycle_time:.1f}s. "
+                f"{request_count} balance requests in {fetch_time:.1f}s "
+                f"({requests_per_second:.1f} requests/s, concurrency {concurrency}). "
+                f"Balance table: {table_hits} hits, {request_count} misses, "
+                f"{balance_table.fallbacks - fallbacks_before} last known balances used. "
+                f"Role edits: {stats['role_edits']} sent, "
+                f"{stats['role_skipped']} mutations skipped. "
+                f"Channel edits: {stats['channel_edits']} sent, "
+                f"{stats['channel_skipped']} mutations skipped."
+            )
+            mutation_stats = mutation_scheduler.stats()
+            print(
+                f"Mutation queue: {mutation_stats['depth']} queued, "
+                f"{mutation_stats['applied']} applied, {mutation_stats['merged']} merged, "
+                f"{mutation_stats['unchanged']} unchanged, {mutation_stats['failed']} failed. "
+                f"Time to apply: {mutation_stats['avg_apply_time']:.1f}s avg, "
+                f"{mutation_stats['max_apply_time']:.1f}s max."
+            )
+            print(
+                f"Rally latency: {rally_api.client.latency_summary()}. "
+                f"Retries: {dict(rally_api.client.retried)}. "
+                f"Circuit breaker: {rally_api.client.breaker.state}."
+            )
+            api_clients = (
+                ("Rally", rally_api.client),
+                ("CoinGecko", coingecko_api.client),
+            )
+            for name, api_client in api_clients:
+                coalesced = list(api_client.coalesced_stats().items())[:5]
+                if coalesced:
+                    print(
+                        f"{name} callers coalesced into in-flight requests: "
+                        + ", ".join(f"{path} {count}" for path, count in coalesced)
+                    )
+
+    async def sync_guild(
+        self,
+        guild,
+        stats,
+        concurrency,
+        after_member_id=0,
+        save_checkpoint=None,
+        last_sync=None,
+    ):
+        """
+        Reconcile the roles and channel overwrites of the linked members of a guild,
+        SYNC_BATCH_SIZE members at a time in member id order.
+
+        Every batch waits for the rally and discord call budget of sync_budget.
+        Members whose balances couldn't be fetched are synced from their last
+        known balances without revoking anything.
+
+        @param guild: guild to sync
+        @param stats: Counter the guild totals are added to
+        @param concurrency: balance requests in flight at once
+        @param after_member_id: members up to this id were synced by an interrupted cycle
+        @param save_checkpoint: called with the last member id of every finished batch
+        @param last_sync: time of the guild's previous full sync, balances fetched since are reused
+        @return: False if the guild's sync lease was lost or Rally became unavailable
+        """
+        worker_id = config.CONFIG.worker_id
+
+        stats["guilds"] += 1
+        chunk_calls_before = member_index.chunk_calls
+        await member_index.ensure_complete(guild)
+        sync_budget.record("discord", member_index.chunk_calls - chunk_calls_before)
+
+        threshold_index = ThresholdIndex(
+            data.get_role_mappings(guild.id), data.get_channel_mappings(guild.id)
+        )
+        stats["mappings"] += len(threshold_index)
+
+        linked_members = []
+        for member in guild.members:
+            stats["members"] += 1
+            rally_id = data.rally_connections.get(member.id)
+            if not rally_id:
+                # nothing to evaluate, a member linking later is evaluated without fingerprint
+                member_index.clear_dirty(member)
+            elif member.id > after_member_id:
+                linked_members.append((member, rally_id))
+        linked_members.sort(key=lambda linked: linked[0].id)
+        stats["linked_members"] += len(linked_members)
+
+        # members whose relevant balances and guild mappings are unchanged are skipped
+        stored_fingerprints = data.get_balance_fingerprints(guild.id) or {}
+
+        for batch_start in range(0, len(linked_members), SYNC_BATCH_SIZE):
+            batch = linked_members[batch_start : batch_start + SYNC_BATCH_SIZE]
+
+            await sync_budget.wait()
+
+            # fetch every balance of the batch up front, many requests in flight at once
+            fetch_start = time.monotonic()
+            misses_before = balance_table.misses
+            batch_balances = await balance_table.get_many(
+                [rally_id for _, rally_id in batch], concurrency, fresh_after=last_sync
+            )
+            sync_budget.record("rally", balance_table.misses - misses_before)
+            stats["fetch_time"] += time.monotonic() - fetch_start
+
+            # the batch is synced again once the breaker closes, not from failed balances
+            if not rally_api.client.breaker.allow():
+                return False
+
+            if not data.renew_sync_lease(guild.id, worker_id, SYNC_LEASE_TIME):
+                return False
+
+            new_fingerprints = []
+            member_balances = []
+            stale_members = set()
+            now = time.time()
+            for member, rally_id in batch:
+                balances = batch_balances[rally_id]
+                if balances is None:
+                    continue
+
+                coin_balances = rally_api.balances_by_coin(balances)
+                if isinstance(balances, LastKnownBalances):
+                    # no fingerprint is stored, the next fresh balances are fully evaluated
+                    stats["members_stale"] += 1
+                    stale_members.add(member)
+                    member_balances.append((member, coin_balances))
+                    continue
+
+                fingerprint = balance_fingerprint(threshold_index, coin_balances)
+                stored = stored_fingerprints.get(rally_id)
+                if (
+                    stored is not None
+                    and not member_index.is_dirty(member)
+                    and stored[0] == fingerprint
+                    and now - stored[1] < FINGERPRINT_MAX_AGE
+                ):
+                    stats["members_skipped"] += 1
+                    continue
+
+                # members seen for the first time or only marked dirty aren't churn
+                if stored is not None and stored[0] != fingerprint:
+                    stats["balance_changes"] += 1
+                stats["members_evaluated"] += 1
+                # cleared before the edits are queued, a failed edit marks the member again
+                member_index.clear_dirty(member)
+                new_fingerprints.append((member, rally_id, fingerprint))
+                member_balances.append((member, coin_balances))
+
+            for member, coin_balances in member_balances:
+                edits, skipped = await reconcile_member_roles(
+                    threshold_index,
+                    member,
+                    coin_balances,
+                    mutation_scheduler,
+                    revoke=member not in stale_members,
+                )
+                stats["role_edits"] += edits
+                stats["role_skipped"] += skipped
+
+            edits, skipped = await reconcile_channel_overwrites(
+                threshold_index,
+                guild,
+                member_balances,
+                mutation_scheduler,
+                stale_members,
+            )
+            stats["channel_edits"] += edits
+            stats["channel_skipped"] += skipped
+
+            # members with queued edits get their fingerprint once the edits are applied
+            pending_fingerprints.store(guild.id, new_fingerprints, mutation_scheduler)
+
+            # a restart drops queued edits, the checkpoint stays before their members
+            if save_checkpoint:
+                last_member_id = batch[-1][0].id
+                first_pending = mutation_scheduler.first_pending(guild.id)
+                if first_pending is not None:
+                    last_member_id = min(last_member_id, first_pending - 1)
+                save_checkpoint(last_member_id)
+
+        return True
 
     @commands.command(
         name='change_rally_id',
@@ -642,47 +2044,61 @@ class UpdateTask(commands.Cog):
     )
     @commands.guild_only()
     async def set_rally_id(self, ctx):
-        member = ctx.author
-
-        with self.update_lock:
-            for guild in self.bot.guilds:
-                await guild.chunk()
-
-                if not member in guild.members:
-                    continue
-
-                role_mappings = list(data.get_role_mappings(guild.id))
-                channel_mappings = list(data.get_channel_mappings(guild.id))
-
-                rally_id = data.get_rally_id(member.id)
-                if rally_id:
-                    balances = rally_api.get_balances(rally_id)
-                    for role_mapping in role_mappings:
-                        try:
-                            await grant_deny_role_to_member(
-                                role_mapping, member, balances
-                            )
-                        except discord.HTTPException:
-                            raise errors.RequestError("network error, try again later")
-                        except:
-                            # Forbidden, NotFound or Invalid Argument exceptions only called when code
-                            # or bot is wrongly synced / setup
-                            raise errors.FatalError("bot is setup wrong, call admin")
-                    for channel_mapping in channel_mappings:
-                        try:
-                            await grant_deny_channel_to_member(
-                                channel_mapping, member, balances
-                            )
-                        except discord.HTTPException:
-                            raise errors.RequestError("network error, try again later")
-                        except:
-                            # Forbidden, NotFound or Invalid Argument exceptions only called when code
-                            # or bot is wrongly synced / setup
-                            raise errors.FatalError("bot is setup wrong, call admin")
-
-            await pretty_print(
+        # no update_lock, only this member's guilds are touched
+        rally_id = data.get_rally_id(ctx.author.id)
+        if not rally_id:
+            return await pretty_print(
                 ctx,
                 "Command completed successfully!",
                 title="Success",
                 color=SUCCESS_COLOR,
             )
+
+        # fetched once and shared by every guild below
+        balances = await balance_table.get(rally_id, refresh=True)
+        coin_balances = None
+        fresh = not isinstance(balances, LastKnownBalances)
+        if balances is not None:
+            coin_balances = rally_api.balances_by_coin(balances)
+
+        for guild, member in member_index.mutual_guilds(self.bot.guilds, ctx.author.id):
+            threshold_index = ThresholdIndex(
+                data.get_role_mappings(guild.id), data.get_channel_mappings(guild.id)
+            )
+
+            try:
+                await reconcile_member_roles(
+                    threshold_index, member, coin_balances, revoke=fresh
+                )
+            except discord.HTTPException:
+                raise errors.RequestError("network error, try again later")
+            except:
+                # Forbidden, NotFound or Invalid Argument exceptions only called when code
+                # or bot is wrongly synced / setup
+                raise errors.FatalError("bot is setup wrong, call admin")
+            try:
+                await reconcile_channel_overwrites(
+                    threshold_index,
+                    guild,
+                    [(member, coin_balances)],
+                    grant_only=() if fresh else {member},
+                )
+            except discord.HTTPException:
+                raise errors.RequestError("network error, try again later")
+            except:
+                # Forbidden, NotFound or Invalid Argument exceptions only called when code
+                # or bot is wrongly synced / setup
+                raise errors.FatalError("bot is setup wrong, call admin")
+
+            if coin_balances is not None and fresh:
+                data.set_balance_fingerprints(
+                    guild.id,
+                    {rally_id: balance_fingerprint(threshold_index, coin_balances)},
+                )
+
+        await pretty_print(
+            ctx,
+            "Command completed successfully!",
+            title="Success",
+            color=SUCCESS_COLOR,
+        )
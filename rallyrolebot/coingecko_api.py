@@ -1,68 +1,272 @@
+import asyncio
 import json
+import os
+import time
 
-import requests
-
+import config
 from constants import *
+from utils.http import APIError, JSONClient, run_sync
+
+
+class CoinGeckoAPIError(APIError):
+    service = "CoinGecko"
+
+
+class CoinGeckoClient(JSONClient):
+    """Client of the CoinGecko API, see JSONClient."""
+
+    error_class = CoinGeckoAPIError
+
+    def __init__(self):
+        super().__init__(
+            COINGECKO_API_URL,
+            COINGECKO_CONNECTION_LIMIT,
+            COINGECKO_TIMEOUT,
+            COINGECKO_CONNECT_TIMEOUT,
+            API_LATENCY_BUCKETS,
+            endpoint_timeouts=COINGECKO_ENDPOINT_TIMEOUTS,
+        )
+
+    async def get_coins_list(self):
+        return await self.request("coins_list", "/coins/list")
+
+    async def get_coin(self, id):
+        return await self.request("coin", "/coins/" + id)
+
+    async def get_markets(self, ids):
+        """
+        @param ids: up to COINGECKO_MARKETS_BATCH coin ids
+        @return: list of market data of the coins that have any, in USD
+        """
+        return await self.request(
+            "markets",
+            "/coins/markets",
+            {
+                "vs_currency": "usd",
+                "ids": ",".join(sorted(ids)),
+                "per_page": len(ids),
+                "price_change_percentage": "24h,30d",
+            },
+        )
+
+
+class CoinIndex:
+    """
+    The CoinGecko coin ids of /coins/list indexed by lowercase symbol.
+
+    Lookups are dict reads without network. The index is saved to the
+    coingecko_index_path config after every download and loaded from it at
+    startup, so a restart doesn't wait for the multi-megabyte list. After
+    COINGECKO_INDEX_TTL seconds it is refreshed in the background while the
+    old one is still served. A symbol that isn't in the index is unknown
+    until that refresh, a price lookup never downloads the list.
+    """
+
+    def __init__(self, coingecko_client):
+        self.client = coingecko_client
+        self.ids = {}
+        self.updated = None
+        self.loaded = False
+        self.refreshing = False
+
+    def load(self):
+        """Read the index saved by a previous run, if there is one."""
+        self.loaded = True
+        try:
+            with open(config.CONFIG.coingecko_index_path) as file:
+                saved = json.load(file)
+            self.ids = saved["ids"]
+            self.updated = saved["updated"]
+        except (OSError, ValueError, KeyError):
+            pass
+
+    def save(self):
+        path = config.CONFIG.coingecko_index_path
+        try:
+            # written next to the old file and swapped in, a crash never leaves half an index
+            with open(path + ".tmp", "w") as file:
+                json.dump({"updated": self.updated, "ids": self.ids}, file)
+            os.replace(path + ".tmp", path)
+        except OSError as e:
+            print(f"Failed to save the CoinGecko coin index: {e}")
+
+    async def refresh(self):
+        """Download the index again, a failed download keeps the old one."""
+        # concurrent refreshes share one request through the client's single flight
+        try:
+            coins = await self.client.get_coins_list()
+        except CoinGeckoAPIError as e:
+            print(e)
+            return
+
+        ids = {}
+        for coin in coins:
+            # several coins share some symbols, the first one in the list is used
+            ids.setdefault(coin["symbol"].lower(), coin["id"])
+        self.ids = ids
+        self.updated = time.time()
+        self.save()
+
+    async def background_refresh(self):
+        try:
+            await self.refresh()
+        finally:
+            self.refreshing = False
+
+    def start(self):
+        """Load the saved index and refresh it in the background if it is outdated."""
+        if self.loaded:
+            return
+        self.load()
+        if self.updated is None or time.time() - self.updated >= COINGECKO_INDEX_TTL:
+            self.refreshing = True
+            asyncio.ensure_future(self.background_refresh())
+
+    async def get(self, symbol):
+        """
+        @param symbol: coin symbol in any case, e.g. "btc"
+        @return: CoinGecko id of the coin or None if there is no such coin
+        """
+        if not self.loaded:
+            self.load()
+        if self.updated is None:
+            await self.refresh()
+        elif time.time() - self.updated >= COINGECKO_INDEX_TTL and not self.refreshing:
+            self.refreshing = True
+            asyncio.ensure_future(self.background_refresh())
 
+        return self.ids.get(symbol.lower())
 
-def returnReqError(url, result):
-    print("Request error!")
-    print(f"Url: {url}")
-    print(f"Status Code: {result.status_code}")
-    print(f"JSON result type: {type(result.json())}")
-    print(result.json())
+
+class MarketData:
+    """
+    Prices and price changes of CoinGecko coins.
+
+    The /coins/markets response of many coins is a fraction of the size of a
+    single /coins/{id} document. Missing coins are requested together in
+    batches of COINGECKO_MARKETS_BATCH ids and served for
+    COINGECKO_MARKET_DATA_TTL seconds.
+    """
+
+    def __init__(self, coingecko_client):
+        self.client = coingecko_client
+        self.prices = {}
+
+    def prune(self):
+        now = time.monotonic()
+        expired = [
+            coin_id
+            for coin_id, (fetched_at, _) in self.prices.items()
+            if now - fetched_at >= COINGECKO_MARKET_DATA_TTL
+        ]
+        for coin_id in expired:
+            del self.prices[coin_id]
+
+    async def get_many(self, ids):
+        """
+        @param ids: iterable of CoinGecko coin ids
+        @return: dict of coin id -> price data of the coins that have market data
+        @raise CoinGeckoAPIError: if the market data can't be fetched
+        """
+        self.prune()
+        result = {}
+        missing = []
+        for coin_id in set(ids):
+            entry = self.prices.get(coin_id)
+            if entry is not None:
+                result[coin_id] = entry[1]
+            else:
+                missing.append(coin_id)
+
+        batches = [
+            missing[start : start + COINGECKO_MARKETS_BATCH]
+            for start in range(0, len(missing), COINGECKO_MARKETS_BATCH)
+        ]
+        responses = await asyncio.gather(
+            *[self.client.get_markets(batch) for batch in batches]
+        )
+        fetched_at = time.monotonic()
+        for markets in responses:
+            for market in markets:
+                price_data = {
+                    "current_price": market["current_price"],
+                    "price_change_percentage_24h": market[
+                        "price_change_percentage_24h_in_currency"
+                    ],
+                    "price_change_percentage_30d": market[
+                        "price_change_percentage_30d_in_currency"
+                    ],
+                }
+                self.prices[market["id"]] = (fetched_at, price_data)
+                result[market["id"]] = price_data
+        return result
+
+
+client = CoinGeckoClient()
+coin_index = CoinIndex(client)
+market_data = MarketData(client)
 
 
 def get_coins_list():
-    url = COINGECKO_API_URL + "/coins/list"
-    result = requests.get(url)
-    if result.status_code != 200:
-        returnReqError(url, result)
+    try:
+        return run_sync(client.get_coins_list())
+    except CoinGeckoAPIError as e:
+        print(e)
         return False
 
-    return result.json()
 
+async def get_id_from_symbol_async(symbol):
+    """
+    @return: CoinGecko id of the coin or False if there is no such coin
+    """
+    coin_id = await coin_index.get(symbol)
+    return coin_id if coin_id is not None else False
 
-def valid_coin(symbol):
-    symbol = symbol.lower()
 
-    coins = get_coins_list()
-    if coins is False:
-        return False
+async def valid_coin_async(symbol):
+    return await coin_index.get(symbol) is not None
 
-    for keyval in coins:
-        if symbol == keyval["symbol"].lower():
-            return True
-    return False
 
+def valid_coin(symbol):
+    return run_sync(valid_coin_async(symbol))
 
-def get_id_from_symbol(symbol):
-    symbol = symbol.lower()
 
-    coins = get_coins_list()
-    if coins is False:
-        return False
+def get_id_from_symbol(symbol):
+    return run_sync(get_id_from_symbol_async(symbol))
 
-    for keyval in coins:
-        if symbol == keyval["symbol"].lower():
-            return keyval["id"]
-    return False
 
+async def get_price_data_async(symbol):
+    """
+    @return: dict of the current price and its 24h and 30d change, False if there is no such coin,
+        None if the coin has no market data
+    @raise CoinGeckoAPIError: if the price data can't be fetched
+    """
+    return (await get_price_data_many_async([symbol]))[symbol]
 
-def get_price_data(symbol):
-    id = get_id_from_symbol(symbol)
-    if id is False:
-        return False
 
-    url = COINGECKO_API_URL + "/coins/" + id
-    result = requests.get(url)
-    if result.status_code != 200:
-        returnReqError(url, result)
-        return False
+async def get_price_data_many_async(symbols):
+    """
+    Price data of many coins with one request for all coins that aren't cached.
 
-    result = result.json()["market_data"]
+    @param symbols: iterable of coin symbols
+    @return: dict of symbol -> price data like get_price_data_async, False if there is no such coin,
+        None if the coin has no market data
+    @raise CoinGeckoAPIError: if the price data can't be fetched
+    """
+    symbols = list(symbols)
+    ids = {symbol: await coin_index.get(symbol) for symbol in symbols}
+    prices = await market_data.get_many(
+        [coin_id for coin_id in ids.values() if coin_id is not None]
+    )
     return {
-        "current_price": result["current_price"]["usd"],
-        "price_change_percentage_24h": result["price_change_percentage_24h"],
-        "price_change_percentage_30d": result["price_change_percentage_30d"],
+        symbol: False if ids[symbol] is None else prices.get(ids[symbol])
+        for symbol in symbols
     }
+
+
+def get_price_data(symbol):
+    try:
+        return run_sync(get_price_data_async(symbol))
+    except CoinGeckoAPIError as e:
+        print(e)
+        return False
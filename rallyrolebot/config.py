@@ -1,4 +1,6 @@
 import configargparse
+import os
+import socket
 
 CONFIG = None
 
@@ -23,7 +25,78 @@ arg_parser.add("--host", default="127.0.0.1", help="Bind socket to this host")
 
 arg_parser.add("--port", default="8000", help="Bind socket to this port")
 
-arg_parser.add("--cache_max", default="5000", help="Maximun entries to store in cache")
+arg_parser.add(
+    "--price_retention_days",
+    default="7",
+    help="Days every sampled coin price is kept, hourly and daily rollups are kept longer",
+)
+
+arg_parser.add(
+    "--hourly_price_retention_days",
+    default="365",
+    help="Days the hourly coin price rollups are kept, daily rollups are kept forever",
+)
+
+arg_parser.add(
+    "--coingecko_index_path",
+    default="coingecko_coins.json",
+    help="File the CoinGecko symbol to id index is saved to between restarts",
+)
+
+arg_parser.add(
+    "--price_interval",
+    default="600",
+    help="Seconds between two stored prices of a creator coin whose price is changing",
+)
+
+arg_parser.add(
+    "--price_concurrency",
+    default="10",
+    help="Maximum number of Rally price requests in flight while sampling prices",
+)
+
+arg_parser.add(
+    "--balance_concurrency",
+    default="20",
+    help="Maximum number of Rally balance requests in flight during an update",
+)
+
+arg_parser.add(
+    "--balance_max_staleness",
+    default="3600",
+    help="Seconds the last known balances of a rally id may be used while Rally requests fail",
+)
+
+arg_parser.add(
+    "--partitioned_sync",
+    action="store_true",
+    help="Deprecated, every process only updates guilds whose sync lease it acquires",
+)
+
+arg_parser.add(
+    "--sync_worker",
+    action="store_true",
+    help="Run as a sync worker that only updates roles",
+)
+
+arg_parser.add(
+    "--worker_id",
+    default=f"{socket.gethostname()}-{os.getpid()}",
+    help="Name of this process in the sync leases table",
+)
+
+
+arg_parser.add(
+    "--rally_calls_per_minute",
+    default="6000",
+    help="Rally requests the bot and all sync workers may make per minute, 0 for no limit",
+)
+
+arg_parser.add(
+    "--discord_calls_per_minute",
+    default="1200",
+    help="Discord edits the bot and all sync workers may send per minute, 0 for no limit",
+)
 
 
 def parse_args():
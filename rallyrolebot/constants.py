@@ -16,15 +16,25 @@ USERS_TABLE = "users"
 USERS_TOKEN_TABLE = "users_token"
 COMMANDS_TABLE = "commands"
 COIN_PRICE_TABLE = "coin_price"
+COIN_PRICE_HOURLY_TABLE = "coin_price_hourly"
+COIN_PRICE_DAILY_TABLE = "coin_price_daily"
 
 
 GUILD_ID_KEY = "guildId"
 PRICE_KEY = "priceInUSD"
+OPEN_KEY = "open"
+HIGH_KEY = "high"
+LOW_KEY = "low"
+CLOSE_KEY = "close"
+AVG_KEY = "avg"
+SAMPLES_KEY = "samples"
 REQUIRED_BALANCE_KEY = "requiredBalance"
 ROLE_NAME_KEY = "roleName"
 CHANNEL_NAME_KEY = "channel"
 DISCORD_ID_KEY = "discordId"
 RALLY_ID_KEY = "rallyId"
+RALLY_USERNAME_KEY = "rallyUsername"
+USERNAME_CHECKED_KEY = "usernameChecked"
 
 BOT_TOKEN_KEY = "botToken"
 BOT_INSTANCES_KEY = "botInstances"
@@ -70,6 +80,43 @@ EVENT_KEY = 'event'
 
 TASKS_TABLE = 'tasks_table'
 
+API_STATUS_TABLE = "api_status"
+SERVICE_KEY = "service"
+STATE_KEY = "state"
+OPEN_UNTIL_KEY = "openUntil"
+
+SYNC_LEASES_TABLE = "sync_leases"
+WORKER_ID_KEY = "workerId"
+LEASE_EXPIRES_KEY = "leaseExpires"
+LAST_SYNCED_KEY = "lastSynced"
+
+BALANCE_FINGERPRINTS_TABLE = "balance_fingerprints"
+FINGERPRINT_KEY = "fingerprint"
+TIME_UPDATED_KEY = "timeUpdated"
+
+BALANCE_SNAPSHOTS_TABLE = "balance_snapshots"
+BALANCES_KEY = "balances"
+TIME_FETCHED_KEY = "timeFetched"
+
+SYNC_CHECKPOINTS_TABLE = "sync_checkpoints"
+CYCLE_STARTED_KEY = "cycleStarted"
+LAST_MEMBER_ID_KEY = "lastMemberId"
+
+GUILD_SYNC_STATUS_TABLE = "guild_sync_status"
+LAST_FULL_SYNC_KEY = "lastFullSync"
+SYNC_INTERVAL_KEY = "syncInterval"
+CHURN_KEY = "churn"
+WEBHOOK_EVENTS_KEY = "webhookEvents"
+
+SYNC_PLANS_TABLE = "sync_plans"
+REPORT_KEY = "report"
+
+CALL_BUDGET_TABLE = "call_budget"
+BUDGET_WINDOW_KEY = "budgetWindow"
+CALL_KIND_KEY = "callKind"
+WINDOW_START_KEY = "windowStart"
+CALLS_KEY = "calls"
+
 
 """
  Constants useful for  rally_api module
@@ -81,12 +128,140 @@ BASE_URL = "https://api.rally.io/v1"
 COINGECKO_API_URL = "https://api.coingecko.com/api/v3"
 DISCORD_API_URL = "https://discord.com/api"
 
+# keep-alive connections the Rally client pools per event loop
+RALLY_CONNECTION_LIMIT = 100
+
+# seconds a Rally request may take in total and to connect
+RALLY_TIMEOUT = 10
+RALLY_CONNECT_TIMEOUT = 5
+
+# total timeout per Rally endpoint, the full coin list is the slowest response
+RALLY_ENDPOINT_TIMEOUTS = {
+    "balance": 5,
+    "user": 5,
+    "price": 5,
+    "creator_coins": 15,
+}
+
+# retries of a failed Rally GET, waiting a random time up to (first, longest) seconds doubling per retry
+RALLY_RETRIES = 2
+RALLY_BACKOFF = (0.5, 5)
+
+# failed Rally requests in a row that open the circuit breaker, and its (first, longest) cooldown
+RALLY_BREAKER_FAILURES = 20
+RALLY_BREAKER_COOLDOWN = (30, 600)
+
+# upper bounds in seconds of the Rally and CoinGecko latency histogram buckets
+API_LATENCY_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+# keep-alive connections and request timeouts of the CoinGecko client
+COINGECKO_CONNECTION_LIMIT = 20
+COINGECKO_TIMEOUT = 10
+COINGECKO_CONNECT_TIMEOUT = 5
+
+# the full coin list is several megabytes
+COINGECKO_ENDPOINT_TIMEOUTS = {"coins_list": 30}
+
+# seconds the CoinGecko coin index is served before it is refreshed in the background
+COINGECKO_INDEX_TTL = 6 * 3600
+
+# ids per /coins/markets request, the most CoinGecko returns on one page
+COINGECKO_MARKETS_BATCH = 250
+
+# seconds fetched CoinGecko market data is served without another request
+COINGECKO_MARKET_DATA_TTL = 60
+
+# coins one prices command shows, an embed holds at most 25 fields
+PRICES_MAX_COINS = 25
+
+# seconds between two runs of the price poller of the API
+PRICE_POLL_TICK = 60
+
+# a coin whose price didn't change is sampled half as often, down to once per this many seconds,
+# the hourly sampling of every coin before --price_interval
+PRICE_MAX_INTERVAL = 3600
+
+# the 24 hour change is only computed from a price stored at most this far from 24 hours ago
+PRICE_24H_MAX_DISTANCE = 2 * PRICE_MAX_INTERVAL
+
+# seconds between two deletions of prices older than their retention
+PRICE_RETENTION_TICK = 3600
+
+# seconds the price API serves a coin's current price without asking Rally again
+CURRENT_PRICE_TTL = 10
+
+# seconds the creator coin catalogue is served before it is refreshed in the background
+COIN_CATALOGUE_TTL = 600
+
 
 """
     Constants useful for update_cog module
 """
+# sync interval of a guild without scheduling history
 UPDATE_WAIT_TIME = 600
 
+# bounds of the per guild sync interval picked by the update scheduler
+SCHEDULE_MIN_INTERVAL = 120
+SCHEDULE_MAX_INTERVAL = 3600
+
+# seconds the update scheduler sleeps between checks for due guilds
+SCHEDULE_TICK = 15
+
+# weight of the last sync in a guild's churn average
+SCHEDULE_CHURN_SMOOTHING = 0.5
+
+# webhook events since the last sync that count as a fully active guild
+SCHEDULE_WEBHOOK_EVENTS = 10
+
+# how much faster than UPDATE_WAIT_TIME a fully active guild is synced
+SCHEDULE_ACTIVITY_WEIGHT = 4
+
+# linked members above which an active guild is sped up less, by the square root of its size
+SCHEDULE_MEMBERS_REFERENCE = 1000
+
+# a guild lease not renewed for this long is taken over by another sync worker
+SYNC_LEASE_TIME = 300
+
+# seconds between two writes of the calls a process counted to the shared call budget
+CALL_BUDGET_FLUSH_TIME = 5
+
+# seconds an update waits before checking an exhausted call budget again
+CALL_BUDGET_POLL_TIME = 5
+
+# (requests, seconds) budget per discord rate limit bucket for queued role and permission edits
+MUTATION_RATE_LIMITS = {
+    "member_roles": (10, 10),
+    "channel_overwrites": (5, 5),
+}
+
+# (requests, seconds) budget per bot across all routes, below discord's global limit
+MUTATION_GLOBAL_RATE_LIMIT = (40, 1)
+
+# lower values are resynced first
+RESYNC_PRIORITY_WEBHOOK = 1
+
+# rally usernames looked up per update cycle for accounts linked before usernames were stored
+USERNAME_BACKFILL_LIMIT = 500
+
+# seconds before the username of a rally id whose lookup failed is looked up again
+USERNAME_RECHECK_TIME = 24 * 3600
+
+# members with an unchanged fingerprint are still fully evaluated once this old
+FINGERPRINT_MAX_AGE = 24 * 3600
+
+# seconds a process's circuit breaker state is listed after its last report, every update
+# cycle reports and a guild waits at most SCHEDULE_MAX_INTERVAL between cycles
+API_STATUS_MAX_AGE = 2 * SCHEDULE_MAX_INTERVAL
+
+# linked members reconciled between two checkpoints of the update cycle
+SYNC_BATCH_SIZE = 500
+
+# values per IN clause and rows per bulk write, SQLite allows 999 bound parameters
+DB_BATCH_SIZE = 400
+
+# role and channel diffs listed per field by the plan command, the rest is counted
+PLAN_DIFFS_SHOWN = 10
+
 """
     Miscellaneous constants
 """
@@ -117,4 +292,6 @@ API_TAGS_METADATA = [
     {"name": "bot_instance", "description": "Bot instances"},
     {"name": "bot_avatar", "description": "Configure bot avatar"},
     {"name": "bot_name", "description": "Configure bot name"},
+    {"name": "sync", "description": "Role sync status in server"},
+    {"name": "status", "description": "State of the external APIs used by the bot"},
 ]
@@ -4,6 +4,9 @@ import json
 import config
 import time
 
+from sqlalchemy import and_, bindparam, or_
+from sqlalchemy.exc import IntegrityError
+
 from constants import *
 from utils.ext import connect_db
 
@@ -25,6 +28,8 @@ from utils.ext import connect_db
     #################### rally_connections ######################
     discordId
     rallyId
+    rallyUsername
+    usernameChecked
     
     #################### channel_prefixes ######################
     guildId
@@ -54,12 +59,77 @@ from utils.ext import connect_db
     description
     
     #################### coin_price #################
-    date
-    price
+    timeCreated
+    priceInUSD
+    coinKind
+
+    #################### coin_price_hourly, coin_price_daily #################
     coinKind
+    timeCreated
+    open
+    high
+    low
+    close
+    avg
+    samples
+
+    #################### balance_snapshots #################
+    rallyId
+    balances
+    timeFetched
+
+    #################### sync_leases #################
+    guildId
+    workerId
+    leaseExpires
+    lastSynced
+
+    #################### balance_fingerprints #################
+    guildId
+    rallyId
+    fingerprint
+    timeUpdated
+
+    #################### sync_checkpoints #################
+    botId
+    cycleStarted
+    guildId
+    lastMemberId
+
+    #################### guild_sync_status #################
+    guildId
+    lastFullSync
+    syncInterval
+    churn
+    webhookEvents
+
+    #################### sync_plans #################
+    guildId
+    report
+    timeCreated
+
+    #################### api_status #################
+    service
+    workerId
+    state
+    failures
+    trips
+    openUntil
+    cooldown
+    timeUpdated
+
+    #################### call_budget #################
+    budgetWindow
+    callKind
+    windowStart
+    calls
 
 """
 
+# discord id -> rally id of every linked account, filled by load_rally_connections
+# and kept current by add_discord_rally_mapping and remove_discord_rally_mapping
+rally_connections = {}
+
 
 @connect_db
 def add_role_coin_mapping(db, guild_id, coin, required_balance, role):
@@ -123,6 +193,15 @@ def get_channel_mappings(db, guild_id, coin=None, required_balance=None, channel
     return filtered_mappings
 
 
+@connect_db
+def get_guild_ids_by_mapped_coin(db, coins):
+    guild_ids = set()
+    for table_name in [ROLE_MAPPINGS_TABLE, CHANNEL_MAPPINGS_TABLE]:
+        for row in db[table_name].find(coinKind=list(coins)):
+            guild_ids.add(row[GUILD_ID_KEY])
+    return guild_ids
+
+
 @connect_db
 def remove_role_mapping(db, guild_id, coin, required_balance, role):
 
@@ -145,9 +224,13 @@ def remove_channel_mapping(db, guild_id, coin, required_balance, channel):
 
 
 @connect_db
-def add_discord_rally_mapping(db, discord_id, rally_id):
+def add_discord_rally_mapping(db, discord_id, rally_id, rally_username=None):
     table = db[RALLY_CONNECTIONS_TABLE]
-    table.upsert({DISCORD_ID_KEY: discord_id, RALLY_ID_KEY: rally_id}, [DISCORD_ID_KEY])
+    row = {DISCORD_ID_KEY: discord_id, RALLY_ID_KEY: rally_id}
+    if rally_username:
+        row[RALLY_USERNAME_KEY] = rally_username.lower()
+    table.upsert(row, [DISCORD_ID_KEY])
+    rally_connections[discord_id] = rally_id
 
 
 @connect_db
@@ -160,6 +243,63 @@ def get_rally_id(db, discord_id):
     return None
 
 
+@connect_db
+def get_rally_ids_by_usernames(db, usernames):
+    table = db[RALLY_CONNECTIONS_TABLE]
+    usernames = [username.lower() for username in usernames]
+    return {row[RALLY_ID_KEY] for row in table.find(rallyUsername=usernames)}
+
+
+@connect_db
+def get_rally_ids_without_username(db, limit):
+    """
+    @return: rally ids without a username whose lookup wasn't tried in the last
+        USERNAME_RECHECK_TIME seconds, ids that were never tried first
+    """
+    table = db[RALLY_CONNECTIONS_TABLE]
+    if not table.exists:
+        return []
+    table.create_column(RALLY_USERNAME_KEY, db.types.text)
+    table.create_column(USERNAME_CHECKED_KEY, db.types.float)
+
+    columns = table.table.c
+    checked = columns[USERNAME_CHECKED_KEY]
+    statement = (
+        table.table.select()
+        .where(
+            and_(
+                columns[RALLY_USERNAME_KEY].is_(None),
+                or_(checked.is_(None), checked < time.time() - USERNAME_RECHECK_TIME),
+            )
+        )
+        .order_by(checked.isnot(None), checked)
+        .limit(limit)
+    )
+    return [row[RALLY_ID_KEY] for row in db.executable.execute(statement)]
+
+
+@connect_db
+def set_usernames_checked(db, rally_ids):
+    """Record a username lookup of rally ids, found or not, so failed ones wait for a retry."""
+    table = db[RALLY_CONNECTIONS_TABLE]
+    statement = (
+        table.table.update()
+        .where(table.table.c[RALLY_ID_KEY].in_(list(rally_ids)))
+        .values({USERNAME_CHECKED_KEY: time.time()})
+    )
+    db.executable.execute(statement)
+
+
+@connect_db
+def set_rally_usernames(db, usernames):
+    table = db[RALLY_CONNECTIONS_TABLE]
+    for rally_id, username in usernames.items():
+        table.update(
+            {RALLY_ID_KEY: rally_id, RALLY_USERNAME_KEY: username.lower()},
+            [RALLY_ID_KEY],
+        )
+
+
 @connect_db
 def get_all_users(db):
 
@@ -176,6 +316,44 @@ def remove_discord_rally_mapping(db, discord_id, rally_id):
         discordId=discord_id,
         rallyId=rally_id,
     )
+    if rally_connections.get(discord_id) == rally_id:
+        del rally_connections[discord_id]
+
+
+@connect_db
+def get_rally_connections(db):
+    """
+    @return: dict of discord id -> rally id of every linked account, from a single query
+    """
+    table = db[RALLY_CONNECTIONS_TABLE]
+    return {row[DISCORD_ID_KEY]: row[RALLY_ID_KEY] for row in table.all()}
+
+
+def load_rally_connections():
+    """
+    Reload the in-memory rally_connections index with a single query.
+
+    @return: dict of discord id -> rally id
+    """
+    loaded = get_rally_connections()
+    rally_connections.clear()
+    rally_connections.update(loaded)
+    return rally_connections
+
+
+@connect_db
+def get_discord_ids(db, rally_id):
+    """
+    @return: discord ids of the accounts linked to a rally id
+    """
+    table = db[RALLY_CONNECTIONS_TABLE]
+    if not table.exists:
+        return []
+    # webhook resyncs look every changed rally id up
+    if RALLY_CONNECTIONS_TABLE not in _indexed_tables:
+        table.create_index([RALLY_ID_KEY])
+        _indexed_tables.add(RALLY_CONNECTIONS_TABLE)
+    return [row[DISCORD_ID_KEY] for row in table.find(rallyId=rally_id)]
 
 
 @connect_db
@@ -344,37 +522,190 @@ def add_coin_price(db, price, coin):
     )
 
 
+# tables whose index was checked by this process, inspecting indexes takes a query per call
+_indexed_tables = set()
+
+
+def _coin_price_table(db):
+    table = db[COIN_PRICE_TABLE]
+    # lookups by coin and time, like the 24 hour change, are range scans of this index
+    if COIN_PRICE_TABLE not in _indexed_tables and table.exists:
+        table.create_index([COIN_KIND_KEY, TIME_CREATED_KEY])
+        _indexed_tables.add(COIN_PRICE_TABLE)
+    return table
+
+
 @connect_db
 def add_coin_price_multiple(db, prices):
+    """
+    Store the prices of many coins with one insert.
+
+    @param prices: dict of coin -> price
+    """
     table = db[COIN_PRICE_TABLE]
-    table.insert_many(prices)
+    now = datetime.datetime.now()
+    table.insert_many(
+        [
+            {TIME_CREATED_KEY: now, PRICE_KEY: price, COIN_KIND_KEY: coin}
+            for coin, price in prices.items()
+        ]
+    )
+    _coin_price_table(db)
+
+
+def _coin_price_rollup_table(db, name):
+    table = db[name]
+    if not table.exists:
+        table.create_column(COIN_KIND_KEY, db.types.string(64))
+        table.create_column(TIME_CREATED_KEY, db.types.datetime)
+        for key in (OPEN_KEY, HIGH_KEY, LOW_KEY, CLOSE_KEY, AVG_KEY):
+            table.create_column(key, db.types.float)
+        table.create_column(SAMPLES_KEY, db.types.integer)
+        table.create_index([COIN_KIND_KEY, TIME_CREATED_KEY])
+    return table
+
+
+def _roll_up(rows, bucket_start):
+    """
+    Merge rollups, in time order, into one rollup per coin and bucket.
+
+    @param rows: iterable of rollup dicts, a single price is a rollup of one sample
+    @param bucket_start: function of a datetime -> start of its bucket
+    @return: list of rollup dicts
+    """
+    rollups = {}
+    for row in rows:
+        key = (row[COIN_KIND_KEY], bucket_start(row[TIME_CREATED_KEY]))
+        total = row[AVG_KEY] * row[SAMPLES_KEY]
+        rollup = rollups.get(key)
+        if rollup is None:
+            rollups[key] = {
+                COIN_KIND_KEY: key[0],
+                TIME_CREATED_KEY: key[1],
+                OPEN_KEY: row[OPEN_KEY],
+                HIGH_KEY: row[HIGH_KEY],
+                LOW_KEY: row[LOW_KEY],
+                CLOSE_KEY: row[CLOSE_KEY],
+                AVG_KEY: total,
+                SAMPLES_KEY: row[SAMPLES_KEY],
+            }
+            continue
+
+        rollup[HIGH_KEY] = max(rollup[HIGH_KEY], row[HIGH_KEY])
+        rollup[LOW_KEY] = min(rollup[LOW_KEY], row[LOW_KEY])
+        rollup[CLOSE_KEY] = row[CLOSE_KEY]
+        rollup[AVG_KEY] += total
+        rollup[SAMPLES_KEY] += row[SAMPLES_KEY]
+
+    for rollup in rollups.values():
+        rollup[AVG_KEY] /= rollup[SAMPLES_KEY]
+    return list(rollups.values())
 
 
 @connect_db
-def clean_price_cache(db, limit):
-    table = db[COIN_PRICE_TABLE]
-    old = table.all(order_by="id", _limit=limit)
-    for price in old:
-        table.delete(id=price["id"])
+def roll_up_coin_prices(db, since):
+    """
+    Rebuild the hourly and daily rollups of the prices stored since a time.
+
+    Only hours whose prices are all still stored may be rebuilt, the rollup
+    of an hour that retention already cut into would lose its first prices.
+
+    @param since: datetime, the hours and the day containing it are rebuilt from there on
+    """
+    since = since.replace(minute=0, second=0, microsecond=0)
+    filters = {TIME_CREATED_KEY: {">=": since}}
+    samples = (
+        {
+            COIN_KIND_KEY: row[COIN_KIND_KEY],
+            TIME_CREATED_KEY: row[TIME_CREATED_KEY],
+            **{
+                key: float(row[PRICE_KEY])
+                for key in (OPEN_KEY, HIGH_KEY, LOW_KEY, CLOSE_KEY, AVG_KEY)
+            },
+            SAMPLES_KEY: 1,
+        }
+        for row in db[COIN_PRICE_TABLE].find(order_by=TIME_CREATED_KEY, **filters)
+    )
+    hourly = _roll_up(
+        samples, lambda time: time.replace(minute=0, second=0, microsecond=0)
+    )
+    if not hourly:
+        return
+
+    hourly_table = _coin_price_rollup_table(db, COIN_PRICE_HOURLY_TABLE)
+    hourly_table.upsert_many(hourly, [COIN_KIND_KEY, TIME_CREATED_KEY])
+
+    # days are rebuilt from their hours, the raw prices of their first hours may be gone
+    first_day = min(rollup[TIME_CREATED_KEY] for rollup in hourly).replace(hour=0)
+    daily = _roll_up(
+        hourly_table.find(timeCreated={">=": first_day}, order_by=TIME_CREATED_KEY),
+        lambda time: time.replace(hour=0, minute=0, second=0, microsecond=0),
+    )
+    _coin_price_rollup_table(db, COIN_PRICE_DAILY_TABLE).upsert_many(
+        daily, [COIN_KIND_KEY, TIME_CREATED_KEY]
+    )
 
 
 @connect_db
-def price_count(db):
-    table = db[COIN_PRICE_TABLE]
-    return table.__len__()
+def delete_old_coin_prices(db, raw_days, hourly_days):
+    """
+    Delete prices and hourly rollups older than their retention, daily rollups are kept.
+    """
+    now = datetime.datetime.now()
+    # one range delete per table instead of a delete per row
+    db[COIN_PRICE_TABLE].delete(
+        timeCreated={"<": now - datetime.timedelta(days=raw_days)}
+    )
+    _coin_price_rollup_table(db, COIN_PRICE_HOURLY_TABLE).delete(
+        timeCreated={"<": now - datetime.timedelta(days=hourly_days)}
+    )
 
 
 @connect_db
 def get_coin_prices(db, coin, limit):
     limit = limit or 24
-    table = db[COIN_PRICE_TABLE]
+    table = _coin_price_table(db)
     return table.find(coinKind=coin, order_by="-id", _limit=limit)
 
 
+@connect_db
+def get_coin_price_rollups(db, coin, resolution, limit):
+    """
+    @param resolution: "hour" or "day"
+    @return: newest rollups of a coin first
+    """
+    limit = limit or 24
+    name = COIN_PRICE_HOURLY_TABLE if resolution == "hour" else COIN_PRICE_DAILY_TABLE
+    table = _coin_price_rollup_table(db, name)
+    return table.find(coinKind=coin, order_by=f"-{TIME_CREATED_KEY}", _limit=limit)
+
+
 @connect_db
 def get_last_24h_price(db, coin):
-    table = db[COIN_PRICE_TABLE]
-    return list(table.find(coinKind=coin, order_by="-id", _limit=24))[-1]
+    """
+    @return: the stored price nearest to 24 hours ago, None if no price was stored
+        within PRICE_24H_MAX_DISTANCE seconds of it
+    """
+    # prices aren't sampled at a fixed rate, so the row 24 samples back isn't 24 hours back
+    table = _coin_price_table(db)
+    day_ago = datetime.datetime.now() - datetime.timedelta(days=1)
+    before = table.find_one(
+        coinKind=coin, timeCreated={"<=": day_ago}, order_by=f"-{TIME_CREATED_KEY}"
+    )
+    after = table.find_one(
+        coinKind=coin, timeCreated={">": day_ago}, order_by=TIME_CREATED_KEY
+    )
+    nearest = min(
+        [price for price in (before, after) if price is not None],
+        key=lambda price: abs(price[TIME_CREATED_KEY] - day_ago),
+        default=None,
+    )
+    # a coin sampled for less than a day has no price to compare with
+    if nearest is None or abs(nearest[TIME_CREATED_KEY] - day_ago) > datetime.timedelta(
+        seconds=PRICE_24H_MAX_DISTANCE
+    ):
+        return None
+    return nearest
 
 
 @connect_db
@@ -640,3 +971,459 @@ def delete_task(db, id):
 def get_tasks(db):
     table = db[TASKS_TABLE]
     return [t for t in table.all()]
+
+
+def _bulk_upsert(db, table, rows, keys):
+    """
+    Upsert many rows with one select, one insert and one update statement.
+
+    dataset's upsert_many selects and writes every row on its own.
+
+    @param rows: list of dicts with the same columns
+    @param keys: columns identifying a row
+    """
+    if not rows:
+        return
+    if not table.exists:
+        table.insert_many(rows)
+        return
+    if len(rows) > DB_BATCH_SIZE:
+        for start in range(0, len(rows), DB_BATCH_SIZE):
+            _bulk_upsert(db, table, rows[start : start + DB_BATCH_SIZE], keys)
+        return
+
+    existing = {
+        tuple(row[key] for key in keys)
+        for row in table.find(**{key: list({row[key] for row in rows}) for key in keys})
+    }
+    new_rows = []
+    updates = []
+    for row in rows:
+        if tuple(row[key] for key in keys) in existing:
+            # bound parameters can't share the names of the updated columns
+            updates.append({f"_{column}": value for column, value in row.items()})
+        else:
+            new_rows.append(row)
+
+    if new_rows:
+        table.insert_many(new_rows)
+    if updates:
+        columns = table.table.c
+        statement = (
+            table.table.update()
+            .where(and_(*[columns[key] == bindparam(f"_{key}") for key in keys]))
+            .values(
+                {
+                    column: bindparam(f"_{column}")
+                    for column in rows[0]
+                    if column not in keys
+                }
+            )
+        )
+        db.executable.execute(statement, updates)
+
+
+def _balance_fingerprints_table(db):
+    table = db[BALANCE_FINGERPRINTS_TABLE]
+    # every sync looks fingerprints up by guild and rally id
+    if BALANCE_FINGERPRINTS_TABLE not in _indexed_tables:
+        if not table.exists:
+            table.create_column(GUILD_ID_KEY, db.types.bigint)
+            table.create_column(RALLY_ID_KEY, db.types.string(64))
+            table.create_column(FINGERPRINT_KEY, db.types.string(40))
+            table.create_column(TIME_UPDATED_KEY, db.types.float)
+        table.create_index([GUILD_ID_KEY, RALLY_ID_KEY])
+        _indexed_tables.add(BALANCE_FINGERPRINTS_TABLE)
+    return table
+
+
+@connect_db
+def get_balance_fingerprints(db, guild_id):
+    table = _balance_fingerprints_table(db)
+    return {
+        row[RALLY_ID_KEY]: (row[FINGERPRINT_KEY], row[TIME_UPDATED_KEY])
+        for row in table.find(guildId=guild_id)
+    }
+
+
+@connect_db
+def set_balance_fingerprints(db, guild_id, fingerprints):
+    table = _balance_fingerprints_table(db)
+    now = time.time()
+    _bulk_upsert(
+        db,
+        table,
+        [
+            {
+                GUILD_ID_KEY: guild_id,
+                RALLY_ID_KEY: rally_id,
+                FINGERPRINT_KEY: fingerprint,
+                TIME_UPDATED_KEY: now,
+            }
+            for rally_id, fingerprint in fingerprints.items()
+        ],
+        [GUILD_ID_KEY, RALLY_ID_KEY],
+    )
+
+
+def _balance_snapshots_table(db):
+    return db.create_table(
+        BALANCE_SNAPSHOTS_TABLE,
+        primary_id=RALLY_ID_KEY,
+        primary_type=db.types.string(64),
+    )
+
+
+@connect_db
+def get_balance_snapshots(db, rally_ids):
+    """
+    @param rally_ids: list of rally ids
+    @return: dict of rally id -> (balances, time fetched) of the ids with a stored snapshot
+    """
+    table = _balance_snapshots_table(db)
+    rally_ids = list(rally_ids)
+    snapshots = {}
+    for start in range(0, len(rally_ids), DB_BATCH_SIZE):
+        for row in table.find(rallyId=rally_ids[start : start + DB_BATCH_SIZE]):
+            snapshots[row[RALLY_ID_KEY]] = (
+                json.loads(row[BALANCES_KEY]),
+                row[TIME_FETCHED_KEY],
+            )
+    return snapshots
+
+
+@connect_db
+def set_balance_snapshots(db, snapshots):
+    """
+    Store the last known balances of rally ids.
+
+    @param snapshots: dict of rally id -> (balances, time fetched)
+    """
+    table = _balance_snapshots_table(db)
+    _bulk_upsert(
+        db,
+        table,
+        [
+            {
+                RALLY_ID_KEY: rally_id,
+                BALANCES_KEY: json.dumps(balances),
+                TIME_FETCHED_KEY: fetched_at,
+            }
+            for rally_id, (balances, fetched_at) in snapshots.items()
+        ],
+        [RALLY_ID_KEY],
+    )
+
+
+def _sync_leases_table(db):
+    # guildId is the primary key so two workers can never create the same lease
+    return db.create_table(
+        SYNC_LEASES_TABLE, primary_id=GUILD_ID_KEY, primary_type=db.types.bigint
+    )
+
+
+@connect_db
+def acquire_sync_lease(db, guild_id, worker_id, lease_time, cycle_start):
+    """
+    Take the sync lease of a guild if it is free, expired or already ours,
+    and the guild hasn't been synced since cycle_start.
+
+    @return: True if worker_id now holds the lease
+    """
+    table = _sync_leases_table(db)
+    if table.find_one(guildId=guild_id) is None:
+        try:
+            table.insert(
+                {
+                    GUILD_ID_KEY: guild_id,
+                    WORKER_ID_KEY: "",
+                    LEASE_EXPIRES_KEY: 0.0,
+                    LAST_SYNCED_KEY: 0.0,
+                }
+            )
+        except IntegrityError:
+            # another worker created it first
+            pass
+
+    now = time.time()
+    columns = table.table.c
+    statement = (
+        table.table.update()
+        .where(
+            and_(
+                columns[GUILD_ID_KEY] == guild_id,
+                columns[LAST_SYNCED_KEY] < cycle_start,
+                or_(
+                    columns[LEASE_EXPIRES_KEY] < now,
+                    columns[WORKER_ID_KEY] == worker_id,
+                ),
+            )
+        )
+        .values({WORKER_ID_KEY: worker_id, LEASE_EXPIRES_KEY: now + lease_time})
+    )
+    return db.executable.execute(statement).rowcount == 1
+
+
+@connect_db
+def renew_sync_lease(db, guild_id, worker_id, lease_time):
+    """
+    Extend a lease held by worker_id.
+
+    @return: False if the lease expired and was taken over by another worker
+    """
+    table = _sync_leases_table(db)
+    columns = table.table.c
+    statement = (
+        table.table.update()
+        .where(
+            and_(columns[GUILD_ID_KEY] == guild_id, columns[WORKER_ID_KEY] == worker_id)
+        )
+        .values({LEASE_EXPIRES_KEY: time.time() + lease_time})
+    )
+    return db.executable.execute(statement).rowcount == 1
+
+
+@connect_db
+def complete_sync_lease(db, guild_id, worker_id):
+    table = _sync_leases_table(db)
+    columns = table.table.c
+    statement = (
+        table.table.update()
+        .where(
+            and_(columns[GUILD_ID_KEY] == guild_id, columns[WORKER_ID_KEY] == worker_id)
+        )
+        .values({LEASE_EXPIRES_KEY: 0.0, LAST_SYNCED_KEY: time.time()})
+    )
+    db.executable.execute(statement)
+
+
+def _sync_checkpoints_table(db):
+    table = db.create_table(
+        SYNC_CHECKPOINTS_TABLE, primary_id=BOT_ID_KEY, primary_type=db.types.bigint
+    )
+    # discord ids don't fit the integer column dataset would guess from a 0
+    table.create_column(GUILD_ID_KEY, db.types.bigint)
+    table.create_column(LAST_MEMBER_ID_KEY, db.types.bigint)
+    return table
+
+
+@connect_db
+def get_sync_checkpoint(db, bot_id):
+    """
+    @return: the progress of an unfinished update cycle of bot_id, or None
+    """
+    return _sync_checkpoints_table(db).find_one(botId=bot_id)
+
+
+@connect_db
+def set_sync_checkpoint(db, bot_id, cycle_started, guild_id, last_member_id):
+    _sync_checkpoints_table(db).upsert(
+        {
+            BOT_ID_KEY: bot_id,
+            CYCLE_STARTED_KEY: cycle_started,
+            GUILD_ID_KEY: guild_id,
+            LAST_MEMBER_ID_KEY: last_member_id,
+        },
+        [BOT_ID_KEY],
+    )
+
+
+@connect_db
+def clear_sync_checkpoint(db, bot_id):
+    _sync_checkpoints_table(db).delete(botId=bot_id)
+
+
+def _guild_sync_status_table(db):
+    table = db.create_table(
+        GUILD_SYNC_STATUS_TABLE, primary_id=GUILD_ID_KEY, primary_type=db.types.bigint
+    )
+    # rows are created by whichever write comes first, so every column exists up front
+    table.create_column(LAST_FULL_SYNC_KEY, db.types.float)
+    table.create_column(SYNC_INTERVAL_KEY, db.types.float)
+    table.create_column(CHURN_KEY, db.types.float)
+    table.create_column(WEBHOOK_EVENTS_KEY, db.types.integer)
+    return table
+
+
+@connect_db
+def complete_guild_sync(db, guild_id, sync_interval, churn, webhook_events_seen):
+    """
+    Record a full sync of a guild and the interval until its next one.
+
+    @param sync_interval: seconds until the guild is due again
+    @param churn: average share of linked members whose balances changed
+    @param webhook_events_seen: webhook events the interval was based on, later ones are kept
+    """
+    table = _guild_sync_status_table(db)
+    row = table.find_one(guildId=guild_id)
+    webhook_events = (row[WEBHOOK_EVENTS_KEY] or 0) if row else 0
+    table.upsert(
+        {
+            GUILD_ID_KEY: guild_id,
+            LAST_FULL_SYNC_KEY: time.time(),
+            SYNC_INTERVAL_KEY: sync_interval,
+            CHURN_KEY: churn,
+            WEBHOOK_EVENTS_KEY: max(webhook_events - webhook_events_seen, 0),
+        },
+        [GUILD_ID_KEY],
+    )
+
+
+@connect_db
+def add_guild_webhook_event(db, guild_id):
+    table = _guild_sync_status_table(db)
+    row = table.find_one(guildId=guild_id)
+    webhook_events = (row[WEBHOOK_EVENTS_KEY] or 0) if row else 0
+    table.upsert(
+        {GUILD_ID_KEY: guild_id, WEBHOOK_EVENTS_KEY: webhook_events + 1}, [GUILD_ID_KEY]
+    )
+
+
+@connect_db
+def get_guild_sync_status(db, guild_id):
+    return _guild_sync_status_table(db).find_one(guildId=guild_id)
+
+
+@connect_db
+def get_guild_sync_statuses(db):
+    """
+    @return: dict of guild id -> sync status row of every guild
+    """
+    return {row[GUILD_ID_KEY]: row for row in _guild_sync_status_table(db).all()}
+
+
+def _call_budget_table(db):
+    table = db.create_table(
+        CALL_BUDGET_TABLE,
+        primary_id=BUDGET_WINDOW_KEY,
+        primary_type=db.types.string(64),
+    )
+    # the increment in add_budget_calls needs every column before the first insert
+    table.create_column(CALL_KIND_KEY, db.types.string(16))
+    table.create_column(WINDOW_START_KEY, db.types.bigint)
+    table.create_column(CALLS_KEY, db.types.integer)
+    return table
+
+
+@connect_db
+def add_budget_calls(db, kind, window_start, calls):
+    """
+    Count calls of every process in a one minute window.
+
+    @param kind: kind of call, e.g. "rally"
+    @param window_start: unix time of the start of the minute
+    @param calls: calls made since the last write
+    """
+    table = _call_budget_table(db)
+    window_id = f"{kind}:{window_start}"
+    columns = table.table.c
+    statement = (
+        table.table.update()
+        .where(columns[BUDGET_WINDOW_KEY] == window_id)
+        .values({CALLS_KEY: columns[CALLS_KEY] + calls})
+    )
+    if db.executable.execute(statement).rowcount == 1:
+        return
+
+    try:
+        table.insert(
+            {
+                BUDGET_WINDOW_KEY: window_id,
+                CALL_KIND_KEY: kind,
+                WINDOW_START_KEY: window_start,
+                CALLS_KEY: calls,
+            }
+        )
+    except IntegrityError:
+        # another process created the window first
+        db.executable.execute(statement)
+        return
+    # only the current and the previous window are read
+    table.delete(windowStart={"<": window_start - 60})
+
+
+@connect_db
+def get_budget_calls(db, kind, window_starts):
+    """
+    @return: dict of window start -> calls of every process, for the windows with calls
+    """
+    table = _call_budget_table(db)
+    return {
+        row[WINDOW_START_KEY]: row[CALLS_KEY]
+        for row in table.find(callKind=kind, windowStart=list(window_starts))
+    }
+
+
+def _sync_plans_table(db):
+    return db.create_table(
+        SYNC_PLANS_TABLE, primary_id=GUILD_ID_KEY, primary_type=db.types.bigint
+    )
+
+
+@connect_db
+def set_sync_plan(db, guild_id, report):
+    _sync_plans_table(db).upsert(
+        {
+            GUILD_ID_KEY: guild_id,
+            REPORT_KEY: json.dumps(report),
+            TIME_CREATED_KEY: time.time(),
+        },
+        [GUILD_ID_KEY],
+    )
+
+
+@connect_db
+def get_sync_plan(db, guild_id):
+    """
+    @return: the last dry run report of a guild or None
+    """
+    row = _sync_plans_table(db).find_one(guildId=guild_id)
+    if row is not None:
+        return json.loads(row[REPORT_KEY])
+
+
+def _api_status_table(db):
+    table = db[API_STATUS_TABLE]
+    # openUntil is None while the breaker is closed, so its type can't be guessed from a value
+    table.create_column(OPEN_UNTIL_KEY, db.types.float)
+    return table
+
+
+@connect_db
+def set_api_status(db, service, worker_id, status):
+    """
+    Store the circuit breaker state of an external API as seen by a process.
+
+    @param service: name of the API, e.g. "rally"
+    @param worker_id: process the state was seen by
+    @param status: CircuitBreaker snapshot dict
+    """
+    table = _api_status_table(db)
+    now = time.time()
+    table.upsert(
+        {
+            SERVICE_KEY: service,
+            WORKER_ID_KEY: worker_id,
+            **status,
+            TIME_UPDATED_KEY: now,
+        },
+        [SERVICE_KEY, WORKER_ID_KEY],
+    )
+    # worker ids change with every restart, rows of stopped processes are never updated again
+    table.delete(timeUpdated={"<": now - API_STATUS_MAX_AGE})
+
+
+@connect_db
+def get_api_statuses(db, service):
+    """
+    @return: states of the processes that reported in the last API_STATUS_MAX_AGE seconds
+    """
+    table = _api_status_table(db)
+    return [
+        row
+        for row in table.find(
+            service=service,
+            timeUpdated={">=": time.time() - API_STATUS_MAX_AGE},
+            order_by=f"-{TIME_UPDATED_KEY}",
+        )
+    ]
@@ -26,6 +26,11 @@ class RallyRoleBot(commands.Bot):
         super().__init__(command_prefix=prefix, case_insensitive=True, intents=intents,
                          chunk_guilds_at_startup=True)
 
+        # sync workers only update roles, commands are served by the main bot
+        if config.CONFIG.sync_worker:
+            self.add_cog(cogs.update_cog.UpdateTask(self))
+            return
+
         self.add_cog(cogs.role_cog.RoleCommands(self))
         self.add_cog(cogs.channel_cog.ChannelCommands(self))
         self.add_cog(cogs.rally_cog.RallyCommands(self))
@@ -36,6 +41,11 @@ class RallyRoleBot(commands.Bot):
         for command in self.commands:
             data.add_command(command.name, command.help)
 
+    async def on_message(self, message):
+        if config.CONFIG.sync_worker:
+            return
+        await self.process_commands(message)
+
     async def close(self):
         await super().close()
 
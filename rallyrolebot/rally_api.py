@@ -1,9 +1,10 @@
+import asyncio
 import json
+import time
 from datetime import datetime
 
-import requests
-
 from constants import *
+from utils.http import APIError, CircuitBreaker, JSONClient, run_sync
 
 # TODO: Discuss specific details with Calvin before making changes
 
@@ -16,13 +17,133 @@ def returnReqError(url, result):
     print(result.json())
 
 
+class RallyAPIError(APIError):
+    service = "Rally"
+
+
+class RallyClient(JSONClient):
+    """Client of the Rally API, see JSONClient."""
+
+    error_class = RallyAPIError
+
+    def __init__(self):
+        super().__init__(
+            BASE_URL,
+            RALLY_CONNECTION_LIMIT,
+            RALLY_TIMEOUT,
+            RALLY_CONNECT_TIMEOUT,
+            API_LATENCY_BUCKETS,
+            endpoint_timeouts=RALLY_ENDPOINT_TIMEOUTS,
+            retries=RALLY_RETRIES,
+            backoff=RALLY_BACKOFF,
+            breaker=CircuitBreaker(RALLY_BREAKER_FAILURES, *RALLY_BREAKER_COOLDOWN),
+        )
+
+    async def get_balances(self, rally_id):
+        return await self.request("balance", "/users/rally/" + rally_id + "/balance")
+
+    async def get_user(self, rally_id):
+        return await self.request("user", "/users/rally/" + rally_id)
+
+    async def get_current_price(self, coin_name):
+        return await self.request("price", "/creator_coins/" + coin_name + "/price")
+
+    async def get_creator_coins(self):
+        return await self.request("creator_coins", "/creator_coins")
+
+    async def get_coin_summary(self, coin):
+        return await self.request("summary", "/creator_coins/" + coin + "/summary")
+
+    async def get_coin_rewards(self, coin):
+        return await self.request("rewards", "/creator_coins/" + coin + "/rewards")
+
+
+class CoinCatalogue:
+    """
+    The creator coins of /creator_coins indexed by coinSymbol.
+
+    Lookups are dict reads without network. The first lookup of a process
+    waits for the download, after COIN_CATALOGUE_TTL seconds the catalogue
+    is refreshed in the background while the old one is still served. A
+    symbol that isn't in the catalogue is unknown until that refresh, so
+    lookups of other coins, e.g. from the price commands, never download it.
+    """
+
+    def __init__(self, rally_client):
+        self.client = rally_client
+        self.coins = {}
+        self.updated = None
+        self.refreshing = False
+
+    async def refresh(self):
+        """Download the catalogue again, a failed download keeps the old one."""
+        # concurrent refreshes share one request through the client's single flight
+        try:
+            coins = await self.client.get_creator_coins()
+            self.coins = {coin["coinSymbol"]: coin for coin in coins}
+            self.updated = time.monotonic()
+        except RallyAPIError as e:
+            print(e)
+
+    async def background_refresh(self):
+        try:
+            await self.refresh()
+        finally:
+            self.refreshing = False
+
+    async def load(self):
+        """Download the catalogue if there is none, schedule a refresh if it is outdated."""
+        if self.updated is None:
+            await self.refresh()
+        elif (
+            time.monotonic() - self.updated >= COIN_CATALOGUE_TTL
+            and not self.refreshing
+        ):
+            self.refreshing = True
+            asyncio.ensure_future(self.background_refresh())
+
+    async def symbols(self):
+        """
+        @return: list of the symbols of every creator coin
+        """
+        await self.load()
+        return list(self.coins)
+
+    async def get(self, symbol):
+        """
+        @param symbol: coin symbol, e.g. "STANZ"
+        @return: catalogue entry of the coin or None if there is no such coin
+        """
+        await self.load()
+        return self.coins.get(symbol)
+
+    async def exists(self, symbol):
+        return await self.get(symbol) is not None
+
+    async def image_url(self, symbol):
+        coin = await self.get(symbol)
+        return coin["coinImagePath"] if coin else ""
+
+
+# shared by the bot, the API and the blocking wrappers below
+client = RallyClient()
+catalogue = CoinCatalogue(client)
+
+
+def _request_or(default, coroutine):
+    try:
+        return run_sync(coroutine)
+    except RallyAPIError as e:
+        print(e)
+        return default
+
+
 def get_balances(rally_id):
-    url = BASE_URL + "/users/rally/" + rally_id + "/balance"
-    result = requests.get(url)
-    if result.status_code != 200:
-        returnReqError(url, result)
-        return None
-    return result.json()
+    return _request_or(None, client.get_balances(rally_id))
+
+
+def get_user(rally_id):
+    return _request_or(None, client.get_user(rally_id))
 
 
 def get_balance_of_coin(rally_id, coin_name):
@@ -38,63 +159,46 @@ def find_balance_of_coin(coin_name, balances):
     for coin_balance in balances:
         if coin_balance[COIN_KIND_KEY] == coin_name:
             return float(coin_balance[COIN_BALANCE_KEY])
+    return 0.0
+
+
+def balances_by_coin(balances):
+    """
+    Index a balances response by coin so lookups don't rescan the list.
+
+    @param balances: list of balances as returned by get_balances
+    @return: dict of coin -> balance
+    """
+    if not balances:
+        return {}
+    return {
+        coin_balance[COIN_KIND_KEY]: float(coin_balance[COIN_BALANCE_KEY])
+        for coin_balance in balances
+    }
 
 
 def valid_coin_symbol(coin_name):
-    url = BASE_URL + "/creator_coins/" + coin_name + "/price"
-    result = requests.get(url)
-    if result.status_code != 200:
-        return False
-    return result.json()["symbol"] is not None
+    return run_sync(catalogue.exists(coin_name))
 
 
 def get_current_price(coin_name):
-    url = BASE_URL + "/creator_coins/" + coin_name + "/price"
-    result = requests.get(url)
-    if result.status_code != 200:
-        returnReqError(url, result)
-        return False
-    return result.json()
+    return _request_or(False, client.get_current_price(coin_name))
 
 
 def get_coin_image_url(coin):
-    url = BASE_URL + "/creator_coins/"
-    result = requests.get(url)
-    for data in result.json():
-        if data['coinSymbol'] == coin:
-            return data['coinImagePath']
-
-    return ''
+    return run_sync(catalogue.image_url(coin))
 
 
 def get_coin_summary(coin):
-    url = BASE_URL + "/creator_coins/" + coin + '/summary'
-    result = requests.get(url)
-    if result.status_code != 200:
-        returnReqError(url, result)
-        return False
-
-    return result.json()
+    return _request_or(False, client.get_coin_summary(coin))
 
 
 def get_creator_coins():
-    url = BASE_URL + "/creator_coins"
-    result = requests.get(url)
-    if result.status_code != 200:
-        returnReqError(url, result)
-        return False
-
-    return result.json()
+    return _request_or(False, client.get_creator_coins())
 
 
 def get_coin_rewards(coin):
-    url = BASE_URL + "/creator_coins/" + coin + '/rewards'
-    result = requests.get(url)
-    if result.status_code != 200:
-        returnReqError(url, result)
-        return False
-
-    return result.json()
+    return _request_or(False, client.get_coin_rewards(coin))
 
 
 """
@@ -102,10 +206,17 @@ def get_coin_rewards(coin):
 """
 
 
-def get_price_data(coin_name):
-    data = get_current_price(coin_name)
+async def get_price_data_async(coin_name):
+    """
+    @raise RallyAPIError: if the price can't be fetched
+    """
+    data = await client.get_current_price(coin_name)
     return {
         "current_price": data["priceInUSD"],
         "price_change_percentage_24h": -17,
         "price_change_percentage_30d": 43,
     }
+
+
+def get_price_data(coin_name):
+    return run_sync(get_price_data_async(coin_name))
@@ -7,21 +7,28 @@ import errors
 
 class CommonCoin(commands.Converter):
     async def convert(self, ctx, argument):
-        valid = coingecko_api.valid_coin(argument)
-        if not valid:
+        # the symbol is looked up in the coin index, only the price data is requested
+        try:
+            data = await coingecko_api.get_price_data_async(argument)
+        except coingecko_api.CoinGeckoAPIError:
+            raise errors.RequestError("network error, try again later")
+        if data is False:
             raise errors.InvalidCoin("Invalid coin symbol")
-
-        data = coingecko_api.get_price_data(argument)
+        if data is None:
+            raise errors.RequestError("no market data for this coin")
         return {"symbol": argument, "data": data}
 
 
 class CreatorCoin(commands.Converter):
     async def convert(self, ctx, argument):
-        valid = rally_api.valid_coin_symbol(argument)
+        valid = await rally_api.catalogue.exists(argument)
         if not valid:
             raise errors.InvalidCoin("Invalid coin symbol")
 
-        data = rally_api.get_price_data(argument)
+        try:
+            data = await rally_api.get_price_data_async(argument)
+        except rally_api.RallyAPIError:
+            raise errors.RequestError("network error, try again later")
         return {"symbol": argument, "data": data}
 
 
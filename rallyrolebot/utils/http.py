@@ -0,0 +1,328 @@
+import asyncio
+import random
+import threading
+import time
+
+from collections import Counter
+
+import aiohttp
+
+from utils.metrics import LatencyHistogram
+
+
+class APIError(Exception):
+    """
+    A request to an external API that failed.
+
+    @param endpoint: name of the endpoint, e.g. "balance"
+    @param url: requested url
+    @param status: HTTP status of the response, None if there was no response
+    @param detail: response body or the connection error
+    """
+
+    service = "API"
+
+    def __init__(self, endpoint, url, status=None, detail=None):
+        self.endpoint = endpoint
+        self.url = url
+        self.status = status
+        self.detail = detail
+        super().__init__(
+            f"{self.service} {endpoint} request failed ({status or 'no response'}): "
+            f"{url} {detail or ''}"
+        )
+
+
+class CircuitBreaker:
+    """
+    Stops requests to an API that keeps failing.
+
+    After `failure_threshold` failed requests in a row the breaker opens and
+    requests fail right away for `cooldown` seconds. Once the cooldown is
+    over requests are let through again (half open): the first success
+    closes the breaker, the first failure opens it again with twice the
+    cooldown, up to `max_cooldown`.
+
+    @param on_change: called with the breaker whenever it opens or closes
+    """
+
+    def __init__(self, failure_threshold, cooldown, max_cooldown, on_change=None):
+        self.failure_threshold = failure_threshold
+        self.base_cooldown = cooldown
+        self.max_cooldown = max_cooldown
+        self.on_change = on_change
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = None
+        self.trips = 0
+
+    @property
+    def state(self):
+        if self.open_until is None:
+            return "closed"
+        if time.time() < self.open_until:
+            return "open"
+        return "half_open"
+
+    def allow(self):
+        return self.state != "open"
+
+    def record_success(self):
+        self.failures = 0
+        if self.open_until is not None:
+            self.open_until = None
+            self.cooldown = self.base_cooldown
+            self.changed()
+
+    def record_failure(self):
+        self.failures += 1
+        if self.open_until is not None:
+            # a failure while half open
+            if self.state == "half_open":
+                self.cooldown = min(self.cooldown * 2, self.max_cooldown)
+                self.open(self.cooldown)
+        elif self.failures >= self.failure_threshold:
+            self.open(self.cooldown)
+
+    def open(self, cooldown):
+        self.open_until = time.time() + cooldown
+        self.trips += 1
+        self.changed()
+
+    def changed(self):
+        if self.on_change:
+            try:
+                self.on_change(self)
+            except Exception as e:
+                print(f"Failed to record circuit breaker state: {e}")
+
+    def snapshot(self):
+        """
+        @return: dict of the breaker state, for logs and the API
+        """
+        return {
+            "state": self.state,
+            "failures": self.failures,
+            "trips": self.trips,
+            "openUntil": self.open_until,
+            "cooldown": self.cooldown,
+        }
+
+
+class SingleFlight:
+    """
+    Lets concurrent identical calls share one in-flight call and its result.
+
+    The first caller of a key makes the call, callers arriving while it is in
+    flight wait for the same result or exception instead of repeating it.
+    Callers share the result object and must not modify it. Calls are only
+    shared within an event loop.
+    """
+
+    def __init__(self):
+        self.calls = {}
+        self.coalesced = Counter()
+
+    async def do(self, key, function):
+        """
+        @param key: calls with equal keys are shared
+        @param function: coroutine function making the call
+        @return: result of the call
+        """
+        loop = asyncio.get_event_loop()
+        flight_key = (loop, key)
+        task = self.calls.get(flight_key)
+        if task is not None:
+            self.coalesced[key] += 1
+        else:
+            # the call runs in its own task, cancelling its first caller doesn't cancel it
+            task = asyncio.ensure_future(function())
+            self.calls[flight_key] = task
+            task.add_done_callback(lambda done: self.finish(flight_key, done))
+        # a caller being cancelled must not cancel the shared call
+        return await asyncio.shield(task)
+
+    def finish(self, flight_key, task):
+        del self.calls[flight_key]
+        # retrieved here, so a call whose callers were all cancelled doesn't log a never
+        # retrieved exception
+        if not task.cancelled():
+            task.exception()
+
+
+class JSONClient:
+    """
+    asyncio client of a JSON API.
+
+    Every event loop gets one aiohttp session whose connector keeps up to
+    `connection_limit` connections alive between requests. Failed requests
+    raise `error_class`, identical concurrent requests are coalesced and the
+    latency of every request is recorded in a histogram per endpoint.
+
+    Requests that time out, can't connect or get a 429 or 5xx response are
+    retried `retries` times with jittered exponential backoff. A
+    CircuitBreaker, if given, makes requests fail right away while the API
+    is down.
+
+    @param endpoint_timeouts: dict of endpoint -> total timeout overriding `timeout`
+    @param backoff: tuple of (first, longest) seconds to wait before a retry
+    """
+
+    error_class = APIError
+
+    def __init__(
+        self,
+        base_url,
+        connection_limit,
+        timeout,
+        connect_timeout,
+        latency_buckets,
+        endpoint_timeouts=None,
+        retries=0,
+        backoff=(0.5, 5),
+        breaker=None,
+    ):
+        self.base_url = base_url
+        self.connection_limit = connection_limit
+        self.timeout = aiohttp.ClientTimeout(total=timeout, connect=connect_timeout)
+        self.endpoint_timeouts = {
+            endpoint: aiohttp.ClientTimeout(total=total, connect=connect_timeout)
+            for endpoint, total in (endpoint_timeouts or {}).items()
+        }
+        self.latency_buckets = latency_buckets
+        self.retries = retries
+        self.backoff = backoff
+        self.breaker = breaker
+        self.sessions = {}
+        self.latencies = {}
+        self.single_flight = SingleFlight()
+        self.retried = Counter()
+
+    def session(self):
+        loop = asyncio.get_event_loop()
+        session = self.sessions.get(loop)
+        if session is None or session.closed:
+            session = aiohttp.ClientSession(
+                connector=aiohttp.TCPConnector(limit=self.connection_limit),
+                timeout=self.timeout,
+            )
+            self.sessions[loop] = session
+        return session
+
+    async def request(self, endpoint, path, params=None):
+        """
+        @param endpoint: name the latency, errors and coalesced callers are recorded under
+        @param path: path below the base url
+        @param params: dict of query parameters
+        @return: decoded JSON response, shared with coalesced callers
+        @raise error_class: on a non 200 response, a timeout or a connection error
+        """
+        key = (path, tuple(sorted((params or {}).items())))
+        return await self.single_flight.do(
+            key, lambda: self.send_with_retries(endpoint, path, params)
+        )
+
+    @staticmethod
+    def retryable(error):
+        return error.status is None or error.status == 429 or error.status >= 500
+
+    async def send_with_retries(self, endpoint, path, params=None):
+        for attempt in range(self.retries + 1):
+            if self.breaker is not None and not self.breaker.allow():
+                raise self.error_class(
+                    endpoint, self.base_url + path, detail="circuit breaker open"
+                )
+
+            try:
+                result = await self.send(endpoint, path, params)
+            except self.error_class as e:
+                if not self.retryable(e):
+                    # the API answered, it's the request that is wrong
+                    if self.breaker is not None:
+                        self.breaker.record_success()
+                    raise
+                if self.breaker is not None:
+                    self.breaker.record_failure()
+                if attempt == self.retries:
+                    raise
+
+                self.retried[endpoint] += 1
+                first, longest = self.backoff
+                await asyncio.sleep(random.uniform(0, min(longest, first * 2**attempt)))
+            else:
+                if self.breaker is not None:
+                    self.breaker.record_success()
+                return result
+
+    async def send(self, endpoint, path, params=None):
+        url = self.base_url + path
+        start = time.monotonic()
+        timeout = self.endpoint_timeouts.get(endpoint, self.timeout)
+        try:
+            async with self.session().get(
+                url, params=params, timeout=timeout
+            ) as result:
+                if result.status != 200:
+                    raise self.error_class(
+                        endpoint, url, result.status, await result.text()
+                    )
+                return await result.json()
+        except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+            raise self.error_class(endpoint, url, detail=repr(e)) from e
+        finally:
+            histogram = self.latencies.get(endpoint)
+            if histogram is None:
+                histogram = self.latencies[endpoint] = LatencyHistogram(
+                    self.latency_buckets
+                )
+            histogram.observe(time.monotonic() - start)
+
+    def latency_stats(self):
+        """
+        @return: dict of endpoint -> latency histogram snapshot
+        """
+        return {
+            endpoint: histogram.snapshot()
+            for endpoint, histogram in sorted(self.latencies.items())
+        }
+
+    def coalesced_stats(self):
+        """
+        @return: dict of request path -> callers that shared another caller's request
+        """
+        return {
+            path + (f"?{params}" if params else ""): count
+            for (path, params), count in self.single_flight.coalesced.most_common()
+        }
+
+    def latency_summary(self):
+        """
+        @return: one line of request counts and latencies per endpoint, for logs
+        """
+        return ", ".join(
+            f"{endpoint} {stats['count']} requests avg {stats['avg']:.2f}s "
+            f"p95 {stats['p95']:.2f}s"
+            for endpoint, stats in self.latency_stats().items()
+        )
+
+
+_sync_loop = None
+_sync_loop_lock = threading.Lock()
+
+
+def run_sync(coroutine):
+    """
+    Run a client coroutine from blocking code.
+
+    The coroutine runs on a background event loop, so blocking callers share
+    its pooled connections whether they are called from a thread or from
+    inside another event loop.
+    """
+    global _sync_loop
+    with _sync_loop_lock:
+        if _sync_loop is None:
+            _sync_loop = asyncio.new_event_loop()
+            threading.Thread(
+                target=_sync_loop.run_forever, name="api-clients", daemon=True
+            ).start()
+    return asyncio.run_coroutine_threadsafe(coroutine, _sync_loop).result()
@@ -0,0 +1,54 @@
+import bisect
+
+
+class LatencyHistogram:
+    """
+    Request latencies counted in fixed buckets.
+
+    @param buckets: ascending upper bounds in seconds, slower requests go in a last open bucket
+    """
+
+    def __init__(self, buckets):
+        self.buckets = list(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect.bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        self.max = max(self.max, seconds)
+
+    def quantile(self, q):
+        """
+        @return: upper bound of the bucket holding the q quantile, the max for the open bucket
+        """
+        if not self.count:
+            return 0.0
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return self.max
+
+    def snapshot(self):
+        """
+        @return: dict of counts per bucket and summary values, for logs and the API
+        """
+        return {
+            "count": self.count,
+            "avg": self.total / self.count if self.count else 0.0,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "max": self.max,
+            "buckets": {
+                **{
+                    str(bound): count for bound, count in zip(self.buckets, self.counts)
+                },
+                "inf": self.counts[-1],
+            },
+        }
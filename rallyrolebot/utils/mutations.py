@@ -0,0 +1,425 @@
+import asyncio
+import time
+
+from collections import Counter, OrderedDict
+
+from constants import *
+
+
+class RateBucket:
+    """Token bucket allowing `rate` requests every `per` seconds."""
+
+    def __init__(self, rate, per):
+        self.rate = rate
+        self.per = per
+        self.tokens = rate
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+
+    async def acquire(self):
+        """Wait until a request fits in the budget and take it."""
+        async with self.lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(
+                    self.rate, self.tokens + (now - self.updated) * self.rate / self.per
+                )
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) * self.per / self.rate)
+
+
+class MemberRolesMutation:
+    """
+    Set the mapped roles of a member to the target roles.
+
+    The diff against member.roles is taken again when the mutation is
+    applied, so a queued edit never reverts a newer change.
+    """
+
+    route = "member_roles"
+
+    # (guild id, member id) -> role ids the member has once the sent edit is applied
+    expected_roles = {}
+
+    def __init__(self, member, mapped_roles, target_roles):
+        self.member = member
+        self.mapped_roles = set(mapped_roles)
+        self.target_roles = set(target_roles)
+
+    @property
+    def key(self):
+        return self.route, self.member.guild.id, self.member.id
+
+    @property
+    def bucket(self):
+        return self.route, self.member.guild.me.id, self.member.guild.id
+
+    @property
+    def members(self):
+        return [self.member]
+
+    def merge(self, newer):
+        self.member = newer.member
+        self.mapped_roles = newer.mapped_roles
+        self.target_roles = newer.target_roles
+
+    def desired_roles(self):
+        """
+        @return: the full role list to send or None if nothing would change
+        """
+        # @everyone can't be sent in an edit, every other role the member has is kept
+        current_roles = {role for role in self.member.roles if not role.is_default()}
+        desired_roles = (current_roles - self.mapped_roles) | self.target_roles
+        if desired_roles == current_roles:
+            return None
+        return list(desired_roles)
+
+    def pending(self):
+        return self.desired_roles() is not None
+
+    def diff(self):
+        """
+        @return: tuple of (roles to add, roles to remove)
+        """
+        desired_roles = self.desired_roles()
+        if desired_roles is None:
+            return set(), set()
+        current_roles = {role for role in self.member.roles if not role.is_default()}
+        return set(desired_roles) - current_roles, current_roles - set(desired_roles)
+
+    async def apply(self):
+        desired_roles = self.desired_roles()
+        if desired_roles is None:
+            return False
+
+        # recorded before sending, the member update event can arrive before the response
+        key = (self.member.guild.id, self.member.id)
+        self.expected_roles[key] = {role.id for role in desired_roles}
+        try:
+            await self.member.edit(roles=desired_roles)
+        except Exception:
+            self.expected_roles.pop(key, None)
+            raise
+        print("Updated roles of member")
+        return True
+
+    @classmethod
+    def caused_update(cls, member):
+        """
+        @param member: discord.Member after a member update event
+        @return: True if the member's roles are exactly what the last edit sent for it set
+        """
+        expected = cls.expected_roles.pop((member.guild.id, member.id), None)
+        return expected is not None and expected == {
+            role.id for role in member.roles if not role.is_default()
+        }
+
+
+class ChannelOverwritesMutation:
+    """
+    Set the overwrites of several members in a channel.
+
+    Merging keeps the newest overwrite of every member. The changes are
+    compared with channel.overwrites when applied: a single change is sent
+    with set_permissions, several with one channel.edit call. channel.edit
+    replaces every overwrite and channel.overwrites leaves out members that
+    aren't cached, so it is only used when the guild is fully chunked.
+    """
+
+    route = "channel_overwrites"
+
+    def __init__(self, channel, overwrites):
+        self.channel = channel
+        self.overwrites = dict(overwrites)
+
+    @property
+    def key(self):
+        return self.route, self.channel.id
+
+    @property
+    def bucket(self):
+        return self.route, self.channel.guild.me.id, self.channel.id
+
+    @property
+    def members(self):
+        return list(self.overwrites)
+
+    def merge(self, newer):
+        self.channel = newer.channel
+        self.overwrites.update(newer.overwrites)
+
+    def changed(self):
+        current = self.channel.overwrites
+        return {
+            member: overwrite
+            for member, overwrite in self.overwrites.items()
+            if current.get(member) != overwrite
+        }
+
+    def pending(self):
+        return bool(self.changed())
+
+    async def apply(self):
+        """
+        @return: number of requests sent, 0 if nothing changed
+        """
+        changed = self.changed()
+        if not changed:
+            return 0
+
+        if len(changed) == 1 or not self.channel.guild.chunked:
+            for member, overwrite in changed.items():
+                await self.channel.set_permissions(member, overwrite=overwrite)
+            requests = len(changed)
+        else:
+            overwrites = self.channel.overwrites
+            overwrites.update(changed)
+            await self.channel.edit(overwrites=overwrites)
+            requests = 1
+
+        print(f"Updated {len(changed)} member overwrites in {self.channel.name}")
+        return requests
+
+
+class MutationPlan:
+    """
+    Records mutations instead of applying them, for a dry run of a sync.
+
+    It takes the place of a MutationScheduler so the evaluation runs exactly
+    as in a real sync, and reports the diffs that would have been sent.
+    """
+
+    def __init__(self):
+        self.mutations = OrderedDict()
+
+    def __len__(self):
+        return len(self.mutations)
+
+    def submit(self, mutation):
+        if mutation.key in self.mutations:
+            self.mutations[mutation.key].merge(mutation)
+        else:
+            self.mutations[mutation.key] = mutation
+
+    def role_diffs(self):
+        """
+        @return: list of dicts of the roles every member would gain and lose
+        """
+        diffs = []
+        for mutation in self.mutations.values():
+            if mutation.route != MemberRolesMutation.route:
+                continue
+            added, removed = mutation.diff()
+            if added or removed:
+                diffs.append(
+                    {
+                        "member": str(mutation.member),
+                        "memberId": str(mutation.member.id),
+                        "add": sorted(role.name for role in added),
+                        "remove": sorted(role.name for role in removed),
+                    }
+                )
+        return diffs
+
+    def channel_diffs(self):
+        """
+        @return: list of dicts of the members every channel would allow and deny
+        """
+        diffs = []
+        for mutation in self.mutations.values():
+            if mutation.route != ChannelOverwritesMutation.route:
+                continue
+            changed = mutation.changed()
+            if changed:
+                diffs.append(
+                    {
+                        "channel": mutation.channel.name,
+                        "allow": sorted(
+                            str(member)
+                            for member, overwrite in changed.items()
+                            if overwrite.read_messages
+                        ),
+                        "deny": sorted(
+                            str(member)
+                            for member, overwrite in changed.items()
+                            if not overwrite.read_messages
+                        ),
+                    }
+                )
+        return diffs
+
+
+class MutationScheduler:
+    """
+    Applies queued role and permission edits in the background.
+
+    Mutations are queued per discord rate limit bucket (route, bot and
+    guild or channel) and every bucket is drained by its own task at the
+    budget in MUTATION_RATE_LIMITS, under a per bot MUTATION_GLOBAL_RATE_LIMIT.
+    A mutation for a member or channel that is still queued is merged into
+    the queued one instead of being sent twice. on_settled is called with the
+    members whose queued mutations were all applied or found unchanged,
+    on_failure with every member of a mutation that failed and on_calls with
+    the number of discord requests every applied or failed mutation sent.
+    """
+
+    def __init__(self, on_failure=None, on_settled=None, on_calls=None):
+        self.on_failure = on_failure
+        self.on_settled = on_settled
+        self.on_calls = on_calls
+        self.queues = {}
+        # (guild id, member id) -> queued or in flight mutations of the member
+        self.pending_members = Counter()
+        self.rate_buckets = {}
+        self.global_buckets = {}
+        self.drainers = {}
+
+        self.scheduled = 0
+        self.merged = 0
+        self.applied = 0
+        self.unchanged = 0
+        self.failed = 0
+        self.apply_time_total = 0.0
+        self.apply_time_max = 0.0
+
+    def __len__(self):
+        return sum(len(queue) for queue in self.queues.values())
+
+    def is_pending(self, member):
+        """
+        @return: True if a mutation of the member is queued or being applied
+        """
+        return (member.guild.id, member.id) in self.pending_members
+
+    def first_pending(self, guild_id):
+        """
+        @return: lowest id of a member of the guild with a pending mutation or None
+        """
+        return min(
+            (
+                member_id
+                for pending_guild_id, member_id in self.pending_members
+                if pending_guild_id == guild_id
+            ),
+            default=None,
+        )
+
+    def submit(self, mutation):
+        """
+        Queue a mutation, merging it into a queued one for the same target.
+
+        @param mutation: MemberRolesMutation or ChannelOverwritesMutation
+        """
+        queue = self.queues.setdefault(mutation.bucket, OrderedDict())
+        if mutation.key in queue:
+            queued = queue[mutation.key][0]
+            queued_members = set(queued.members)
+            queued.merge(mutation)
+            new_members = [
+                member for member in queued.members if member not in queued_members
+            ]
+            self.merged += 1
+        else:
+            queue[mutation.key] = (mutation, time.monotonic())
+            new_members = mutation.members
+            self.scheduled += 1
+        for member in new_members:
+            self.pending_members[(member.guild.id, member.id)] += 1
+
+        if mutation.bucket not in self.drainers:
+            self.drainers[mutation.bucket] = asyncio.ensure_future(
+                self.drain(mutation.bucket)
+            )
+
+    async def drain(self, bucket):
+        route, bot_id, _ = bucket
+        if bucket not in self.rate_buckets:
+            self.rate_buckets[bucket] = RateBucket(*MUTATION_RATE_LIMITS[route])
+        if bot_id not in self.global_buckets:
+            self.global_buckets[bot_id] = RateBucket(*MUTATION_GLOBAL_RATE_LIMIT)
+
+        queue = self.queues[bucket]
+        try:
+            while queue:
+                _, (mutation, queued_at) = queue.popitem(last=False)
+                settled = await self.apply(bucket, mutation, queued_at)
+                self.release(mutation, settled)
+        finally:
+            del self.drainers[bucket]
+            if not queue:
+                del self.queues[bucket]
+
+    async def apply(self, bucket, mutation, queued_at):
+        """
+        Send a dequeued mutation within the rate limits of its bucket.
+
+        @return: False if the mutation failed
+        """
+        _, bot_id, _ = bucket
+        if not mutation.pending():
+            self.unchanged += 1
+            return True
+
+        await self.rate_buckets[bucket].acquire()
+        await self.global_buckets[bot_id].acquire()
+        try:
+            applied = await mutation.apply()
+        except Exception as e:
+            self.failed += 1
+            print(f"Failed to apply {mutation.route} mutation: {e}")
+            if self.on_calls:
+                self.on_calls(1)
+            if self.on_failure:
+                for member in mutation.members:
+                    self.on_failure(member)
+            return False
+
+        if not applied:
+            self.unchanged += 1
+            return True
+        if self.on_calls:
+            self.on_calls(int(applied))
+
+        apply_time = time.monotonic() - queued_at
+        self.applied += 1
+        self.apply_time_total += apply_time
+        self.apply_time_max = max(self.apply_time_max, apply_time)
+        return True
+
+    def release(self, mutation, settled):
+        """
+        Stop counting a mutation as pending for its members.
+
+        @param mutation: mutation that was applied, unchanged or failed
+        @param settled: False if it failed, its members are then never reported as settled
+        """
+        settled_members = []
+        for member in mutation.members:
+            key = (member.guild.id, member.id)
+            self.pending_members[key] -= 1
+            if self.pending_members[key] <= 0:
+                del self.pending_members[key]
+                if settled:
+                    settled_members.append(member)
+        if settled_members and self.on_settled:
+            self.on_settled(settled_members)
+
+    def stats(self):
+        """
+        @return: dict of queue depth and time-to-apply metrics
+        """
+        return {
+            "depth": len(self),
+            "scheduled": self.scheduled,
+            "merged": self.merged,
+            "applied": self.applied,
+            "unchanged": self.unchanged,
+            "failed": self.failed,
+            "avg_apply_time": (
+                self.apply_time_total / self.applied if self.applied else 0.0
+            ),
+            "max_apply_time": self.apply_time_max,
+        }
@@ -0,0 +1,96 @@
+import asyncio
+import datetime
+import random
+import time
+
+import config
+import data
+import rally_api
+from constants import *
+from starlette.concurrency import run_in_threadpool
+
+
+class PricePoller:
+    """
+    Samples the prices of the creator coins into the coin_price table.
+
+    Every run requests the coins that are due, at most `concurrency` at a
+    time, and stores their prices with one insert. A coin is due `interval`
+    seconds after its last sample. A coin whose price didn't change waits
+    twice as long as last time, up to PRICE_MAX_INTERVAL, and is back at
+    `interval` as soon as it changes, so a short interval mostly costs
+    requests for coins that are traded. Every wait is shortened by a random
+    tenth, so the coins spread over the runs instead of all being due at once.
+
+    The hourly and daily rollups of the current hour are rebuilt after every
+    insert. The first run also rebuilds every hour that is still completely
+    stored, for prices stored by a previous run that stopped mid-hour.
+
+    @param interval: seconds between two samples of a coin whose price changes
+    @param concurrency: maximum number of price requests in flight
+    """
+
+    def __init__(self, interval, concurrency):
+        self.interval = interval
+        self.concurrency = concurrency
+        self.prices = {}
+        self.waits = {}
+        self.next_sample = {}
+        self.rolled_up = False
+
+    def due(self, symbols):
+        now = time.monotonic()
+        return [symbol for symbol in symbols if self.next_sample.get(symbol, 0) <= now]
+
+    def schedule(self, symbol, price):
+        wait = self.interval
+        if self.prices.get(symbol) == price:
+            wait = min(self.waits.get(symbol, self.interval) * 2, PRICE_MAX_INTERVAL)
+        wait = max(wait, self.interval)
+        self.prices[symbol] = price
+        self.waits[symbol] = wait
+        self.next_sample[symbol] = time.monotonic() + wait * random.uniform(0.9, 1)
+
+    async def poll(self):
+        """
+        Sample the prices of the coins that are due.
+
+        @return: dict of coin -> stored price
+        """
+        started = datetime.datetime.now()
+        semaphore = asyncio.Semaphore(self.concurrency)
+
+        async def fetch_price(symbol):
+            async with semaphore:
+                try:
+                    return symbol, await rally_api.client.get_current_price(symbol)
+                except rally_api.RallyAPIError as e:
+                    print(f"Failed to get price for {symbol}: {e}")
+                    return symbol, None
+
+        symbols = self.due(await rally_api.catalogue.symbols())
+        results = await asyncio.gather(*[fetch_price(symbol) for symbol in symbols])
+
+        # failed coins stay due and are requested again on the next run
+        prices = {
+            symbol: str(price[PRICE_KEY])
+            for symbol, price in results
+            if price is not None
+        }
+        for symbol, price in prices.items():
+            self.schedule(symbol, price)
+        if prices:
+            await run_in_threadpool(data.add_coin_price_multiple, prices)
+        if prices or not self.rolled_up:
+            since = started
+            if not self.rolled_up:
+                # the first full hour after the retention cutoff, the hour before is partly deleted
+                retained = started - datetime.timedelta(
+                    days=int(config.CONFIG.price_retention_days)
+                )
+                since = retained.replace(
+                    minute=0, second=0, microsecond=0
+                ) + datetime.timedelta(hours=1)
+            await run_in_threadpool(data.roll_up_coin_prices, since)
+            self.rolled_up = True
+        return prices
@@ -266,3 +266,33 @@ async def delete_bot_instance(guild_id: int):
             del update_cog.running_bots[bot_instance[BOT_ID_KEY]]
     except:
         pass
+
+
+async def resync_rally_users(usernames: list, coins: list):
+    """
+    Queue the members linked to the given Rally usernames for an immediate resync.
+
+    @param usernames: Rally usernames from a webhook event
+    @param coins: coins whose balances changed
+    """
+    rally_ids = data.get_rally_ids_by_usernames(usernames)
+    if not rally_ids:
+        return
+
+    for rally_id in rally_ids:
+        update_cog.resync_queue.push(rally_id, coins, RESYNC_PRIORITY_WEBHOOK)
+
+
+async def plan_guild_sync(guild_id: int):
+    """
+    Dry run the sync of a guild and store the report for the API.
+
+    @param guild_id: id of guild
+    """
+    bot_object = update_cog.get_bot_for_guild(guild_id)
+    guild = bot_object.get_guild(guild_id) if bot_object else None
+    if guild is None:
+        return
+
+    report = await update_cog.plan_guild(guild)
+    data.set_sync_plan(guild_id, report)